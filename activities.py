@@ -5,13 +5,11 @@ Created on 20 Nov 2013
 '''
 from diary_content import ListManagePopup, EditBlock, ListSummaryInfoBlock, ListManagerEditBlock
 from main import SymptomDiaryApp
-from diary_widgets import ErrorPopup, EditPanelLabel
-from sqlalchemy.orm.exc import NoResultFound
+from diary_widgets import ErrorPopup, EditPanelLabel, WidgetPool
 from kivy.properties import ObjectProperty, StringProperty, BooleanProperty
 import operator
 import sys
-from kivy.uix.label import Label
-from data import Activity, ActivityInfo
+from data import Activity, DetachedCopy
 from kivy.uix.gridlayout import GridLayout
 from kivy.uix.boxlayout import BoxLayout
 
@@ -28,7 +26,10 @@ class ActivityListManagePopup(ListManagePopup):
         return ActivityEditPanel(record)
 
     def create_new_record(self):
-        return Activity(name = "")
+        return DetachedCopy(Activity(name = ""))
+
+    def duplicate_message(self, item):
+        return "Activity %s is already defined in the DB. You must edit that record instead" % (item.name)
 
 
 class ActivityEditPanel(GridLayout):
@@ -49,24 +50,6 @@ class ActivityEditPanel(GridLayout):
             error_popup = ErrorPopup(text="Name must be non-empty and contain only alphanumeric characters")
             error_popup.open()
             return False
-                
-        app = SymptomDiaryApp.get_running_app()  
-        session = app.getDBSession()
-        
-        activity_query = session.query(Activity).filter(Activity.name == name)
-
-        try:
-            result = activity_query.one()
-        except NoResultFound:
-            result = None
-            
-        if (result is not None) and (result.activity_id != self.record.activity_id):
-            # We found a similar record (same name ) but it has a different ID
-            # We should not allow such duplicates            
-            error_popup = ErrorPopup(text = "Activity %s is already defined in the DB. You must edit that record instead" 
-                                                % (name) )
-            error_popup.open()
-            return False
         
         return True
 
@@ -80,44 +63,33 @@ class ActivityEditPanel(GridLayout):
 
 
 class ActivityInfoBlock(ListSummaryInfoBlock):
+    summary_key = 'activity'
  
     def create_edit_block(self):
         return ActivityDetailEditBlock(self.record)
 
     def create_list_manage_popup(self):
         return ActivityListManagePopup(self.record, title="Manage Activities")
-
-    def summarize_record(self):
-        summary = None
-        if (self.record is not None) and (self.record.activity_info is not None):
-            for ai in self.record.activity_info:
-                if (ai.hours) or (ai.minutes):
-                    short_descr = "{} for {:d} hour(s) {:d} minute(s)".format(ai.activity.name, ai.hours, ai.minutes)
-                    if (ai.intensity):
-                        short_descr += ", intensity: {:n}".format(ai.intensity)
-                else:
-                    short_descr = "{}: not taken" .format(ai.activity.name)
-                    
-                if summary is None:
-                    summary = short_descr
-                else:
-                    summary += ", " + short_descr
-        return summary
                    
 
 class ActivityDetailEditBlock(EditBlock):
     activities_block = ObjectProperty()
-    ai_panels = []
-    
+    detail_kind = 'activity'
+
+    def __init__(self, record, **kwargs):
+        self.ai_panels = []
+        super(ActivityDetailEditBlock, self).__init__(record, **kwargs)
 
     def fill_in(self):
-        '''Fill in the fields from the current record'''
-        self._create_activity_info()
+        '''Fill in the fields from the current record, once its details are loaded'''
+        self._load_details(self._fill_in_details)
+
+    def _fill_in_details(self, details):
         prev_ai_panel = None
                 
-        for ai in self.record.activity_info:
-            self.activities_block.add_widget(Label(text=ai.activity.name, size_hint_x=0.2))
-            ai_panel = SingleActivityDetailEditPanel(ai)
+        for ai in details:
+            self._add_label(self.activities_block, ai.activity.name, size_hint_x=0.2)
+            ai_panel = activity_panel_pool.acquire(ai)
             if (prev_ai_panel is not None):
                 prev_ai_panel.last_editable_field.next = ai_panel.first_editable_field
             prev_ai_panel = ai_panel
@@ -128,32 +100,19 @@ class ActivityDetailEditBlock(EditBlock):
             self.ai_panels[0].first_editable_field.focus = True
 
     def update_record(self):
-        '''Update the record with fields from the block'''
+        '''Save the fields of the block to the record'''
         if (self.validate()):
             for ai_panel in self.ai_panels:
                 # this will actually update the record
                 ai_panel.update_record()
+            self._save_edited_details([ai_panel.activity_detail for ai_panel in self.ai_panels])
+
+    def release_panels(self):
+        for ai_panel in self.ai_panels:
+            activity_panel_pool.release(ai_panel)
+        self.ai_panels = []
+        super(ActivityDetailEditBlock, self).release_panels()
                     
-    def _create_activity_info(self):
-        if self.record.activity_info is not None:
-            known_activity_ids = set(map(operator.attrgetter('activity_id'), self.record.activity_info))
-        else:
-            known_activity_ids = set()
-        app = SymptomDiaryApp.get_running_app()  
-        session = app.getDBSession()
-        all_activities_found = session.query(Activity).filter(Activity.active == True).all()
-        not_known_activities = filter(lambda ac: ac.activity_id not in known_activity_ids, all_activities_found )
-        
-        for activity in not_known_activities:
-            ai = ActivityInfo(record_id=self.record.record_id, 
-                               activity_id=activity.activity_id, 
-                               hours = 0,
-                               minutes = 0
-                               )
-            session.add(ai)
-        session.flush()
-        session.refresh(self.record)
-    
     def validate(self):
         for ai_panel in self.ai_panels:
             if (not ai_panel.validate()):
@@ -173,9 +132,15 @@ class SingleActivityDetailEditPanel(BoxLayout):
         super(SingleActivityDetailEditPanel, self).__init__(**kwargs)
         self.fill_in()
 
+    def rebind(self, ad_record):
+        '''Reuse the panel for another activity detail'''
+        self.activity_detail = ad_record
+        self.last_editable_field.next = None
+        self.fill_in()
+
     def fill_in(self):
-        self.hours_input.value = self.activity_detail.hours
-        self.minutes_input.value = self.activity_detail.minutes
+        self.hours_input.reset(self.activity_detail.hours)
+        self.minutes_input.reset(self.activity_detail.minutes)
         self.intensity_slider.value = self.activity_detail.intensity
 
     def update_record(self):
@@ -193,4 +158,8 @@ class SingleActivityDetailEditPanel(BoxLayout):
             ep = ErrorPopup("Minutes must be a number, not empty")
             ep.open()
             return False
-        return True
\ No newline at end of file
+        return True
+
+
+activity_panel_pool = WidgetPool(SingleActivityDetailEditPanel,
+                                 lambda panel, ad_record: panel.rebind(ad_record))
@@ -0,0 +1,247 @@
+'''
+Vectorized time series over the whole diary, for trend analysis.
+
+load_series reads the numeric columns of the diary with a handful of bulk column
+queries (no ORM objects), into NumPy masked arrays indexed by day, covering every day
+from the first to the last entry. Days without an entry, and values that were not
+recorded, are masked. Durations and doses of catalog items (activities, medications,
+treatments) count as 0 on days that have an entry but no detail for the item, since
+only values that were entered are stored.
+
+Requires numpy.
+'''
+from datetime import date
+
+import numpy as np
+import numpy.ma as ma
+
+from data import DETAIL_KINDS
+
+## julianday() of 1970-01-01, the epoch of numpy datetime64
+_UNIX_EPOCH_JULIAN_DAY = 2440587.5
+
+## Per detail kind: (name of the series, SQL expression of the value, fill for recorded days without the detail)
+ITEM_SERIES = {
+    'pain_site': [('painlevel', 'painlevel', None)],
+    'symptom': [('intensity', 'intensity', None)],
+    'medication': [('quantity', 'quantity', 0)],
+    'treatment': [('times_per_day', 'times_per_day', 0),
+                  ('minutes', 'COALESCE(hours, 0) * 60 + COALESCE(minutes, 0)', 0)],
+    'activity': [('minutes', 'COALESCE(hours, 0) * 60 + COALESCE(minutes, 0)', 0),
+                 ('intensity', 'intensity', None)],
+}
+
+ITEM_LABELS = {
+    'pain_site': 'location',
+    'symptom': 'name',
+    'medication': "name || ' ' || COALESCE(dosage, '') || COALESCE(unit, '')",
+    'treatment': 'name',
+    'activity': 'name',
+}
+
+
+def _fetch_columns(connection, sql, dtypes, parameters=()):
+    '''Run a query and return its result columns as numpy arrays, NULLs as nan for float columns'''
+    ## Straight from the DBAPI cursor, the result rows of SQLAlchemy add a lot of overhead per row
+    cursor = connection.connection.cursor()
+    try:
+        rows = cursor.execute(sql, parameters).fetchall()
+    finally:
+        cursor.close()
+    if not rows:
+        return [np.empty(0, dtype=dtype) for dtype in dtypes]
+    ## numpy converts None to nan for float dtypes
+    table = np.array(rows, dtype='f8')
+    return [table[:, i].astype(dtype) for i, dtype in enumerate(dtypes)]
+
+
+class ItemSeries(object):
+    '''Values of one kind of catalog item over time: a days x items masked array'''
+
+    def __init__(self, kind_name, name, item_ids, labels, values):
+        self.kind_name = kind_name
+        self.name = name
+        self.item_ids = item_ids
+        self.labels = labels
+        self.values = values
+
+    def column(self, item_id):
+        return self.values[:, list(self.item_ids).index(item_id)]
+
+
+class DiarySeries(object):
+    '''All the numeric data of a diary, as masked arrays over consecutive days'''
+
+    def __init__(self, first_day, days):
+        self.first_day = first_day
+        self.dates = first_day + np.arange(days)
+        ## True for days which have an entry
+        self.recorded = np.zeros(days, dtype=bool)
+        ## name -> 1-D masked array
+        self.columns = {}
+        ## (kind name, series name) -> ItemSeries
+        self.items = {}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def day_index(self, day):
+        return int((np.datetime64(day, 'D') - self.first_day).astype(int))
+
+    def between(self, start_date, end_date):
+        '''Slice covering [start_date, end_date], to index any of the arrays'''
+        start = max(0, self.day_index(start_date))
+        return slice(start, max(start, self.day_index(end_date) + 1))
+
+    def rolling_mean(self, name, window, min_count=1):
+        return rolling_mean(self.columns[name], window, min_count)
+
+    def percentile(self, name, q):
+        return percentile(self.columns[name], q)
+
+    def resample(self, name, frequency):
+        return resample(self.dates, self.columns[name], frequency)
+
+
+def _masked(values, recorded, fill=None):
+    '''Masked array of float values, masking nan; with fill, recorded days with nan get fill instead'''
+    if fill is not None:
+        values = np.where(recorded & np.isnan(values), fill, values)
+    return ma.masked_invalid(values)
+
+
+def load_series(connection, start_date=None, end_date=None):
+    '''Load the diary numeric data from a SQLAlchemy connection (or session) into a DiarySeries'''
+    if not hasattr(connection, 'exec_driver_sql'):
+        ## a session
+        connection = connection.connection()
+    conditions = []
+    parameters = []
+    if start_date is not None:
+        conditions.append("date_entered >= ?")
+        parameters.append(start_date.isoformat())
+    if end_date is not None:
+        conditions.append("date_entered <= ?")
+        parameters.append(end_date.isoformat())
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    parameters = tuple(parameters)
+
+    record_ids, days = _fetch_columns(
+        connection,
+        "SELECT record_id, CAST(julianday(date_entered) - %r AS INTEGER) FROM entries%s"
+        % (_UNIX_EPOCH_JULIAN_DAY, where),
+        ('i8', 'i8'), parameters)
+    if len(days) == 0:
+        return DiarySeries(np.datetime64(start_date or date.today(), 'D'), 0)
+
+    first_day = days.min()
+    series = DiarySeries(np.datetime64(int(first_day), 'D'), int(days.max() - first_day + 1))
+    series.recorded[days - first_day] = True
+    ## record_id -> day index, -1 for records outside the range
+    day_of_record = np.full(record_ids.max() + 1, -1, dtype='i8')
+    day_of_record[record_ids] = days - first_day
+
+    def scatter(detail_record_ids, values, shape):
+        result = np.full(shape, np.nan)
+        in_range = detail_record_ids <= record_ids.max()
+        day_indexes = np.full(len(detail_record_ids), -1, dtype='i8')
+        day_indexes[in_range] = day_of_record[detail_record_ids[in_range]]
+        return result, day_indexes >= 0, day_indexes
+
+    pain_record_ids, average_pain, max_pain = _fetch_columns(
+        connection, "SELECT record_id, averagepain, maxpain FROM painlevel", ('i8', 'f8', 'f8'))
+    sleep_record_ids, sleep_minutes, sleep_quality = _fetch_columns(
+        connection, "SELECT record_id, hours * 60 + minutes, quality FROM sleep", ('i8', 'f8', 'f8'))
+    for name, detail_record_ids, values in [('average_pain', pain_record_ids, average_pain),
+                                            ('max_pain', pain_record_ids, max_pain),
+                                            ('sleep_minutes', sleep_record_ids, sleep_minutes),
+                                            ('sleep_quality', sleep_record_ids, sleep_quality)]:
+        result, valid, day_indexes = scatter(detail_record_ids, values, len(series))
+        result[day_indexes[valid]] = values[valid]
+        series.columns[name] = _masked(result, series.recorded)
+
+    for kind_name, kind in DETAIL_KINDS.items():
+        item_table = kind.item_class.__tablename__
+        item_ids, = _fetch_columns(connection, "SELECT %s FROM %s ORDER BY %s"
+                                   % (kind.item_key, item_table, kind.item_key), ('i8',))
+        labels = [row[0] for row in connection.exec_driver_sql(
+                    "SELECT %s FROM %s ORDER BY %s" % (ITEM_LABELS[kind_name], item_table, kind.item_key))]
+        column_of_item = np.full((item_ids.max() + 1) if len(item_ids) else 1, -1, dtype='i8')
+        column_of_item[item_ids] = np.arange(len(item_ids))
+
+        value_sql = ", ".join(sql for (name, sql, fill) in ITEM_SERIES[kind_name])
+        fetched = _fetch_columns(connection, "SELECT record_id, %s, %s FROM %s"
+                                 % (kind.item_key, value_sql, kind.detail_class.__tablename__),
+                                 ('i8', 'i8') + ('f8',) * len(ITEM_SERIES[kind_name]))
+        detail_record_ids, detail_item_ids = fetched[0], fetched[1]
+        for (name, sql, fill), values in zip(ITEM_SERIES[kind_name], fetched[2:]):
+            result, valid, day_indexes = scatter(detail_record_ids, values, (len(series), len(item_ids)))
+            result[day_indexes[valid], column_of_item[detail_item_ids[valid]]] = values[valid]
+            series.items[(kind_name, name)] = ItemSeries(kind_name, name, item_ids, labels,
+                                                         _masked(result, series.recorded[:, np.newaxis], fill))
+    return series
+
+
+def rolling_mean(values, window, min_count=1):
+    '''Trailing mean over window days, of the unmasked values only, along the first axis.
+       Masked where fewer than min_count values are available in the window.
+    '''
+    if window < 1:
+        raise ValueError("The rolling window must be at least 1 day, got %s" % window)
+    data = ma.getdata(values).astype(float)
+    valid = ~ma.getmaskarray(values)
+    filled = np.where(valid, data, 0.0)
+    zeros = np.zeros((1,) + filled.shape[1:])
+    sums = np.concatenate([zeros, np.cumsum(filled, axis=0)])
+    counts = np.concatenate([zeros, np.cumsum(valid, axis=0)])
+    window_sums = sums[window:] - sums[:-window]
+    window_counts = counts[window:] - counts[:-window]
+    ## the first window - 1 days only have a partial window
+    window_sums = np.concatenate([sums[1:window], window_sums])[:len(filled)]
+    window_counts = np.concatenate([counts[1:window], window_counts])[:len(filled)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = window_sums / window_counts
+    return ma.masked_where(window_counts < min_count, means)
+
+
+def percentile(values, q):
+    '''Percentile(s) of the unmasked values, along the first axis'''
+    return np.nanpercentile(ma.filled(values.astype(float), np.nan), q, axis=0)
+
+
+def period_keys(dates, frequency):
+    '''Integer period of each date: 'D' days, 'W' weeks starting on Monday, 'M' months, 'Y' years'''
+    if frequency == 'W':
+        ## 1970-01-01 was a Thursday
+        return (dates.astype('datetime64[D]').astype('i8') + 3) // 7
+    if frequency in ('D', 'M', 'Y'):
+        return dates.astype('datetime64[%s]' % frequency).astype('i8')
+    raise ValueError("Unknown resampling frequency %s, must be one of D, W, M, Y" % frequency)
+
+
+def period_start(keys, frequency):
+    if frequency == 'W':
+        return (keys * 7 - 3).astype('datetime64[D]')
+    return keys.astype('datetime64[%s]' % frequency).astype('datetime64[D]')
+
+
+def resample(dates, values, frequency):
+    '''Mean of the unmasked values per period. Returns (period start dates, masked means, counts)'''
+    keys = period_keys(dates, frequency)
+    if len(keys) == 0:
+        return period_start(keys, frequency), ma.masked_array(np.empty((0,) + values.shape[1:])), np.empty(0)
+    groups = keys - keys[0]
+    period_count = int(groups[-1]) + 1
+    data = ma.getdata(values).astype(float)
+    valid = ~ma.getmaskarray(values)
+    sums = np.zeros((period_count,) + values.shape[1:])
+    counts = np.zeros((period_count,) + values.shape[1:])
+    np.add.at(sums, groups, np.where(valid, data, 0.0))
+    np.add.at(counts, groups, valid)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    return (period_start(keys[0] + np.arange(period_count), frequency),
+            ma.masked_where(counts == 0, means), counts)
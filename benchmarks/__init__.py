@@ -0,0 +1,9 @@
+'''
+Headless benchmarks of the diary data paths.
+
+synthetic.py generates diaries of configurable size into fresh SQLite files,
+run.py times the hot operations on them and writes the results as JSON, so that
+runs on different versions of the code can be compared. Neither needs Kivy.
+
+    python -m benchmarks.run --years 10 --symptoms 200 --output results.json
+'''
@@ -0,0 +1,88 @@
+'''
+Compares the commit latency of the SQLite profiles in dbprofile.py.
+
+Each profile gets a fresh synthetic diary, on which a series of small edits is made,
+each followed by a commit, like saving an edit block in the GUI does.
+
+    python -m benchmarks.commit_latency --commits 200 --output commits.json
+'''
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from data import Record, PainInfo
+from dbprofile import PROFILES, apply_profile
+from benchmarks.synthetic import generate_diary
+
+
+def time_commits(db_path, profile_name, commits):
+    engine = create_engine("sqlite:///%s" % db_path)
+    pragmas = apply_profile(engine, profile_name)
+    session = sessionmaker(bind=engine)()
+    records = session.query(Record).order_by(Record.record_id).limit(commits).all()
+
+    durations = []
+    for i, record in enumerate(records):
+        pain_info = record.pain_info
+        if pain_info is None:
+            pain_info = PainInfo(record_id=record.record_id)
+            session.add(pain_info)
+        pain_info.average_pain = i % 11
+        start = time.perf_counter()
+        session.commit()
+        durations.append(time.perf_counter() - start)
+
+    session.close()
+    engine.dispose()
+    durations.sort()
+    return {'pragmas': dict(pragmas),
+            'commits': len(durations),
+            'mean_ms': statistics.mean(durations) * 1000,
+            'median_ms': statistics.median(durations) * 1000,
+            'p95_ms': durations[int(0.95 * (len(durations) - 1))] * 1000,
+            'max_ms': durations[-1] * 1000}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Compare commit latency across SQLite profiles")
+    parser.add_argument('--commits', type=int, default=200)
+    parser.add_argument('--years', type=float, default=1)
+    parser.add_argument('--profiles', nargs='*', default=sorted(PROFILES), choices=sorted(PROFILES))
+    parser.add_argument('--dir', default=None,
+                        help="Directory for the diary files, to measure a particular storage device")
+    parser.add_argument('--output', default=None, help="Write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    work_dir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        template_path = os.path.join(work_dir, 'template.db')
+        diary = generate_diary(template_path, years=args.years, density=1.0)
+        results = {}
+        for profile_name in args.profiles:
+            db_path = os.path.join(work_dir, '%s.db' % profile_name)
+            shutil.copyfile(template_path, db_path)
+            results[profile_name] = time_commits(db_path, profile_name, args.commits)
+    finally:
+        shutil.rmtree(work_dir)
+
+    for profile_name, result in results.items():
+        print("{:<10} mean {:8.3f} ms  median {:8.3f} ms  p95 {:8.3f} ms".format(
+                profile_name, result['mean_ms'], result['median_ms'], result['p95_ms']), file=sys.stderr)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump({'diary': diary, 'results': results}, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
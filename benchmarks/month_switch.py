@@ -0,0 +1,113 @@
+'''
+Times month paging in the calendar DatePicker on a synthetic diary: the fixed grid of
+reused day cells against rebuilding the grid with new widgets for every month, as
+populate_body did before the grid was kept. Both read the entry dates of the month from
+the same in-memory index, so only the widget work differs.
+
+Needs Kivy (but no window):
+
+    python -m benchmarks.month_switch --months 120 --output months.json
+'''
+import os
+## Kivy would otherwise parse the command line itself
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import argparse
+import calendar
+import json
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from calendar import monthrange
+from datetime import date, timedelta
+
+from kivy.uix.gridlayout import GridLayout
+from kivy.uix.label import Label
+
+from benchmarks.synthetic import generate_diary
+from datepicker import DatePicker, DatePickerButton
+from diary_widgets import ColorLabel
+from main import SymptomDiaryApp
+
+
+def rebuild_body(picker):
+    '''The former populate_body: clear the grid and make new widgets for the month'''
+    picker.body.clear_widgets()
+    application = SymptomDiaryApp.get_running_app()
+    first_weekday, numdays = monthrange(picker.month_start.year, picker.month_start.month)
+    today = date.today()
+    entry_dates = application.find_entry_dates_in_month(picker.month_start)
+    for dayname in calendar.day_abbr:
+        picker.body.add_widget(ColorLabel(text=dayname, background_color=picker.background_header,
+                                          size_hint=(0.5, 0.99)))
+    for filler in range(first_weekday):
+        picker.body.add_widget(Label(text=""))
+    for day in range(1, numdays + 1):
+        day_button = DatePickerButton(text=str(day))
+        button_date = picker.month_start.replace(day=day)
+        day_button.bind(on_press=lambda instance, bd=button_date: picker.date_clicked(bd))
+        day_button.border = picker.border_today if (today == button_date) else picker.border_default
+        if (button_date in entry_dates):
+            day_button.background_color = picker.background_defined
+        else:
+            day_button.background_color = picker.background_undefined
+        picker.body.add_widget(day_button)
+
+
+def time_month_switches(picker, populate, first_month, months):
+    durations = []
+    month_start = first_month
+    for i in range(months):
+        picker.month_start = month_start
+        start = time.perf_counter()
+        populate(picker)
+        picker.body.do_layout()
+        durations.append(time.perf_counter() - start)
+        month_start += timedelta(days=monthrange(month_start.year, month_start.month)[1])
+    durations.sort()
+    return {'switches': len(durations),
+            'mean_ms': statistics.mean(durations) * 1000,
+            'median_ms': statistics.median(durations) * 1000,
+            'p95_ms': durations[int(0.95 * (len(durations) - 1))] * 1000,
+            'max_ms': durations[-1] * 1000}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Time month switches in the calendar date picker")
+    parser.add_argument('--months', type=int, default=120, help="Number of month switches to time")
+    parser.add_argument('--output', default=None, help="Write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    work_dir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(work_dir, 'diary.db')
+        years = args.months / 12.0
+        diary = generate_diary(db_path, years=years)
+        ## Made, not run: App() makes it the running app, which the DatePicker talks to
+        app = SymptomDiaryApp(f"sqlite:///{db_path}")
+        first_month = date.fromisoformat(diary['start_date']).replace(day=1)
+        results = {}
+        for name, populate in [('rebuild', rebuild_body), ('reused_grid', DatePicker.populate_body)]:
+            picker = DatePicker()
+            picker.body = GridLayout(cols=7)
+            results[name] = time_month_switches(picker, populate, first_month, args.months)
+        app.db.shutdown()
+        app.store.close()
+    finally:
+        shutil.rmtree(work_dir)
+
+    for name, result in results.items():
+        print("{:<12} mean {:8.3f} ms  median {:8.3f} ms  p95 {:8.3f} ms".format(
+                name, result['mean_ms'], result['median_ms'], result['p95_ms']), file=sys.stderr)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump({'diary': diary, 'results': results}, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,218 @@
+'''
+Times the hot data operations of the diary on a synthetic diary, without a display.
+
+    python -m benchmarks.run --years 10 --symptoms 200 --output results.json
+    python -m benchmarks.run --output new.json --baseline results.json
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from calendar import monthrange
+
+import sqlalchemy
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from data import DETAIL_KINDS, find_record_by_date, find_entry_dates, load_entry_dates,\
+    load_record_with_details, details_for_editing, catalog_page, catalog_page_key
+from entry_index import EntryDateIndex
+from instrumentation import QueryInstrumentation
+from summaries import DETAIL_SUMMARIES, summarize_sleep
+from benchmarks.synthetic import generate_diary, DEFAULT_CATALOG_SIZES
+
+## The option setting the size of each catalog
+CATALOG_SIZE_OPTIONS = {
+    'pain_site': '--pain-sites',
+    'symptom': '--symptoms',
+    'medication': '--medications',
+    'treatment': '--treatments',
+    'activity': '--activities',
+}
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Timer(object):
+    '''Runs an operation over a list of arguments, timing each call and counting its queries'''
+
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+        self.results = {}
+
+    def run(self, name, operation, arguments):
+        durations = []
+        for argument in arguments:
+            start = time.perf_counter()
+            with self.instrumentation.action(name):
+                operation(argument)
+            durations.append(time.perf_counter() - start)
+        durations.sort()
+        stats = self.instrumentation.stats.get(name)
+        queries = stats.queries if stats is not None else 0
+        self.results[name] = {
+            'calls': len(durations),
+            'total_ms': sum(durations) * 1000,
+            'mean_ms': statistics.mean(durations) * 1000,
+            'median_ms': statistics.median(durations) * 1000,
+            'p95_ms': _percentile(durations, 0.95) * 1000,
+            'min_ms': durations[0] * 1000,
+            'max_ms': durations[-1] * 1000,
+            'queries_per_call': queries / len(durations),
+        }
+        return self.results[name]
+
+
+def month_starts(start_date, end_date):
+    month_start = start_date.replace(day=1)
+    while month_start <= end_date:
+        yield month_start
+        month_start += timedelta(days=monthrange(month_start.year, month_start.month)[1])
+
+
+def month_end(month_start):
+    return month_start.replace(day=monthrange(month_start.year, month_start.month)[1])
+
+
+def run_benchmarks(db_path, start_date, end_date, samples=200, seed=0):
+    rng = random.Random(seed)
+    engine = create_engine("sqlite:///%s" % db_path)
+    instrumentation = QueryInstrumentation(print_summary=False)
+    instrumentation.attach(engine)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    timer = Timer(instrumentation)
+
+    all_days = (end_date - start_date).days + 1
+    random_dates = [start_date + timedelta(days=rng.randrange(all_days)) for _ in range(samples)]
+    entry_dates = load_entry_dates(session)
+    entry_samples = [rng.choice(entry_dates) for _ in range(min(samples, len(entry_dates)))]
+    months = list(month_starts(start_date, end_date))
+
+    timer.run('find_entry_by_date', lambda day: find_record_by_date(session, day), random_dates)
+    session.expunge_all()
+
+    timer.run('get_entry_dates', lambda _: load_entry_dates(session), range(max(1, samples // 20)))
+
+    timer.run('month_entry_lookup_db',
+              lambda month: find_entry_dates(session, month, month_end(month)), months)
+
+    index = [None]
+    def build_index(_):
+        index[0] = EntryDateIndex(load_entry_dates(session))
+    timer.run('entry_index_build', build_index, range(max(1, samples // 20)))
+    timer.run('month_entry_lookup_index',
+              lambda month: index[0].dates_in_range(month, month_end(month)), months)
+
+    def load_and_summarize(day):
+        session.expunge_all()
+        record = load_record_with_details(session, day)
+        for summarize in DETAIL_SUMMARIES.values():
+            summarize(record)
+        summarize_sleep(record)
+    timer.run('load_record_and_summarize', load_and_summarize, entry_samples)
+
+    def prepare_editors(day):
+        session.expunge_all()
+        record = load_record_with_details(session, day)
+        for kind_name in DETAIL_KINDS:
+            details_for_editing(session, record, kind_name)
+    timer.run('details_for_editing', prepare_editors, entry_samples[:max(1, samples // 10)])
+
+    def page_through_catalogs(_):
+        session.expunge_all()
+        for kind in DETAIL_KINDS.values():
+            items = catalog_page(session, kind.item_class)
+            while items:
+                items = catalog_page(session, kind.item_class, catalog_page_key(kind.item_class, items[-1]))
+    timer.run('catalog_first_pages',
+              lambda _: [catalog_page(session, kind.item_class) for kind in DETAIL_KINDS.values()],
+              range(max(1, samples // 10)))
+    timer.run('catalog_all_pages', page_through_catalogs, range(max(1, samples // 20)))
+
+    session.close()
+    engine.dispose()
+    return timer.results
+
+
+def compare(results, baseline):
+    lines = ["{:<28} {:>12} {:>12} {:>8}".format("operation", "baseline ms", "current ms", "ratio")]
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None:
+            lines.append("{:<28} {:>12} {:>12.3f} {:>8}".format(name, "-", current['mean_ms'], "-"))
+        else:
+            ratio = current['mean_ms'] / previous['mean_ms'] if previous['mean_ms'] else float('nan')
+            lines.append("{:<28} {:>12.3f} {:>12.3f} {:>8.2f}".format(name, previous['mean_ms'], current['mean_ms'], ratio))
+    return "\n".join(lines)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark diary data operations on a synthetic diary")
+    parser.add_argument('--years', type=float, default=3)
+    parser.add_argument('--density', type=float, default=0.8, help="Fraction of days with an entry")
+    parser.add_argument('--detail-density', type=float, default=0.3,
+                        help="Fraction of catalog items recorded in each entry")
+    for kind_name, size in DEFAULT_CATALOG_SIZES.items():
+        parser.add_argument(CATALOG_SIZE_OPTIONS[kind_name], dest=kind_name, metavar='N', type=int, default=size,
+                            help="Catalog size (default %d)" % size)
+    parser.add_argument('--samples', type=int, default=200, help="Number of calls per operation")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', default=None, help="Keep the generated diary in this file")
+    parser.add_argument('--output', default=None, help="Write the results to this JSON file")
+    parser.add_argument('--baseline', default=None, help="Compare with the results in this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    catalog_sizes = dict((kind_name, getattr(args, kind_name)) for kind_name in DEFAULT_CATALOG_SIZES)
+
+    if args.db is not None:
+        db_path = args.db
+    else:
+        db_fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(db_fd)
+    try:
+        diary = generate_diary(db_path, years=args.years, catalog_sizes=catalog_sizes,
+                               density=args.density, detail_density=args.detail_density, seed=args.seed)
+        results = run_benchmarks(db_path, date.fromisoformat(diary['start_date']),
+                                 date.fromisoformat(diary['end_date']),
+                                 samples=args.samples, seed=args.seed)
+    finally:
+        if args.db is None:
+            os.remove(db_path)
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'environment': {'python': platform.python_version(),
+                              'sqlalchemy': sqlalchemy.__version__,
+                              'sqlite': sqlite3.sqlite_version},
+              'diary': diary,
+              'samples': args.samples,
+              'results': results}
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        print(compare(results, baseline['results']), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
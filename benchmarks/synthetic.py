@@ -0,0 +1,129 @@
+'''
+Generation of synthetic diaries, using the models in data.py.
+'''
+import random
+from datetime import date, timedelta, time
+
+from sqlalchemy import create_engine
+
+from daily_summary import rebuild_daily_summaries
+from data import Base, Record, PainInfo, PainSite, PainSiteInfo, Symptom, SymptomInfo,\
+    Medication, MedicationInfo, Treatment, TreatmentInfo, Activity, ActivityInfo, SleepInfo, DailySummary
+
+
+DEFAULT_CATALOG_SIZES = {
+    'pain_site': 10,
+    'symptom': 20,
+    'medication': 10,
+    'treatment': 5,
+    'activity': 10,
+}
+
+
+def _catalog_rows(catalog_sizes):
+    rows = {}
+    rows[PainSite] = [{'site_id': i, 'location': "site %d" % i, 'active': True}
+                      for i in range(1, catalog_sizes['pain_site'] + 1)]
+    rows[Symptom] = [{'symptom_id': i, 'name': "symptom %d" % i, 'active': True}
+                     for i in range(1, catalog_sizes['symptom'] + 1)]
+    rows[Medication] = [{'medication_id': i, 'name': "medication %d" % i, 'unit': "mg",
+                         'dosage': 10 * (1 + i % 5), 'quantity': 1 + i % 3,
+                         'frequency': "daily", 'active': True}
+                        for i in range(1, catalog_sizes['medication'] + 1)]
+    rows[Treatment] = [{'treatment_id': i, 'name': "treatment %d" % i, 'provider': "provider %d" % (i % 3),
+                        'frequency': "weekly", 'active': True}
+                       for i in range(1, catalog_sizes['treatment'] + 1)]
+    rows[Activity] = [{'activity_id': i, 'name': "activity %d" % i, 'active': True}
+                      for i in range(1, catalog_sizes['activity'] + 1)]
+    return rows
+
+
+def generate_diary(db_path, years=3, catalog_sizes=None, density=0.8, detail_density=0.3,
+                   end_date=None, seed=0, batch_days=1000):
+    '''Create a fresh diary in the SQLite file db_path.
+       density is the fraction of days with an entry, detail_density the fraction of catalog
+       items recorded in each entry. Returns a dict describing what was generated.
+    '''
+    sizes = dict(DEFAULT_CATALOG_SIZES)
+    if catalog_sizes is not None:
+        sizes.update(catalog_sizes)
+    rng = random.Random(seed)
+    if end_date is None:
+        end_date = date.today()
+    start_date = end_date - timedelta(days=int(round(365.25 * years)) - 1)
+
+    engine = create_engine("sqlite:///%s" % db_path)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+    counts = {}
+    with engine.begin() as conn:
+        for item_class, rows in _catalog_rows(sizes).items():
+            if rows:
+                conn.execute(item_class.__table__.insert(), rows)
+            counts[item_class.__tablename__] = len(rows)
+
+    def pick_items(size):
+        return [i for i in range(1, size + 1) if rng.random() < detail_density]
+
+    record_id = 0
+    day = start_date
+    pending = {}
+    while day <= end_date:
+        if rng.random() < density:
+            record_id += 1
+            pending.setdefault(Record, []).append(
+                {'record_id': record_id, 'date_entered': day, 'time_entered': time(21, 0), 'notes': "day %d" % record_id})
+            pain = rng.randint(0, 10)
+            pending.setdefault(PainInfo, []).append(
+                {'record_id': record_id, 'averagepain': pain, 'maxpain': min(10, pain + rng.randint(0, 3))})
+            pending.setdefault(SleepInfo, []).append(
+                {'record_id': record_id, 'hours': rng.randint(3, 10), 'minutes': rng.randint(0, 59),
+                 'quality': rng.randint(0, 10), 'light_out_time': None, 'asleep_time': None, 'awake_time': None})
+            for site_id in pick_items(sizes['pain_site']):
+                pending.setdefault(PainSiteInfo, []).append(
+                    {'record_id': record_id, 'site_id': site_id, 'painlevel': rng.randint(0, 10)})
+            for symptom_id in pick_items(sizes['symptom']):
+                pending.setdefault(SymptomInfo, []).append(
+                    {'record_id': record_id, 'symptom_id': symptom_id, 'intensity': rng.randint(0, 10)})
+            for medication_id in pick_items(sizes['medication']):
+                pending.setdefault(MedicationInfo, []).append(
+                    {'record_id': record_id, 'medication_id': medication_id, 'quantity': rng.randint(0, 3)})
+            for treatment_id in pick_items(sizes['treatment']):
+                pending.setdefault(TreatmentInfo, []).append(
+                    {'record_id': record_id, 'treatment_id': treatment_id, 'times_per_day': rng.randint(0, 2),
+                     'hours': rng.randint(0, 1), 'minutes': rng.choice([0, 15, 30, 45])})
+            for activity_id in pick_items(sizes['activity']):
+                pending.setdefault(ActivityInfo, []).append(
+                    {'record_id': record_id, 'activity_id': activity_id, 'hours': rng.randint(0, 2),
+                     'minutes': rng.choice([0, 15, 30, 45]), 'intensity': rng.randint(0, 10)})
+        day += timedelta(days=1)
+        if (record_id % batch_days == 0) or (day > end_date):
+            _flush_pending(engine, pending, counts)
+
+    ## The rows were inserted without a session, so the summaries are built afterwards
+    with engine.begin() as conn:
+        counts[DailySummary.__tablename__] = rebuild_daily_summaries(conn)
+    engine.dispose()
+    return {'db_path': db_path,
+            'start_date': start_date.isoformat(),
+            'end_date': end_date.isoformat(),
+            'years': years,
+            'density': density,
+            'detail_density': detail_density,
+            'seed': seed,
+            'catalog_sizes': sizes,
+            'row_counts': counts}
+
+
+def _flush_pending(engine, pending, counts):
+    if not pending:
+        return
+    with engine.begin() as conn:
+        ## Record first, the details reference it
+        for model in [Record] + [model for model in pending if model is not Record]:
+            rows = pending.get(model)
+            if rows:
+                conn.execute(model.__table__.insert(), rows)
+                counts[model.__tablename__] = counts.get(model.__tablename__, 0) + len(rows)
+    pending.clear()
@@ -0,0 +1,139 @@
+'''
+The catalog items (pain sites, symptoms, medications, treatments, activities) of the
+session of the application, loaded with one query per catalog and then kept.
+
+The catalogs change rarely, only through the manage popups. The cache has a version
+counter, bumped by the session events set up by track() whenever a flush writes catalog
+rows (so also on every commit of catalog changes) and on every rollback, which expires
+the loaded items. A catalog loaded under an older version is loaded again on its next use.
+
+The cached items are the ORM objects of the session they were loaded with, so they can be
+linked to the details of that session. They must only be used with that session.
+
+duplicate_id is the uniqueness check of the catalog edit panels. Two items of a catalog
+may not have the same key fields (CATALOG_KEY_FIELDS), compared ignoring case, which a
+loaded catalog answers from a map of the lowercased keys to item ids. A catalog that is
+not loaded is checked with one query over the lower(name) index of its table instead.
+'''
+from collections import namedtuple
+from itertools import chain
+
+from sqlalchemy import event, inspect, func
+
+from data import PainSite, Symptom, Medication, Treatment, Activity, DETAIL_KINDS, catalog_name_column
+
+CATALOG_CLASSES = tuple(kind.item_class for kind in DETAIL_KINDS.values())
+
+## The fields identifying the items of each catalog, the name first
+CATALOG_KEY_FIELDS = {
+    PainSite: ('location',),
+    Symptom: ('name',),
+    Medication: ('name', 'unit', 'dosage'),
+    Treatment: ('name',),
+    Activity: ('name',),
+}
+
+## The items of one catalog, ordered by id: all of them, the active ones, all by id,
+## and the id of the first item with each key (see item_key)
+CatalogSnapshot = namedtuple('CatalogSnapshot', ['version', 'items', 'active_items', 'by_id', 'by_key'])
+
+_ASCII_LOWERCASE = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+def item_key(item_class, values):
+    '''The key of an item of item_class with the given {field: value}, with the texts lowercased.
+       Lowercased like lower() in SQLite, which only folds ASCII letters, so that both lookups agree
+    '''
+    key = []
+    for field in CATALOG_KEY_FIELDS[item_class]:
+        value = values[field]
+        if isinstance(value, str):
+            value = value.translate(_ASCII_LOWERCASE)
+        key.append(value)
+    return tuple(key)
+
+
+def _values_of(item):
+    return dict((field, getattr(item, field)) for field in CATALOG_KEY_FIELDS[type(item)])
+
+
+def _id_of(item):
+    return getattr(item, inspect(type(item)).primary_key[0].key)
+
+
+class CatalogCache(object):
+    def __init__(self):
+        self.version = 0
+        ## catalog class -> CatalogSnapshot
+        self._snapshots = {}
+
+    def snapshot(self, session, item_class):
+        '''The CatalogSnapshot of item_class, loading it if it is missing or outdated'''
+        snapshot = self._snapshots.get(item_class)
+        if (snapshot is None) or (snapshot.version != self.version):
+            snapshot = self._snapshots[item_class] = self._load(session, item_class)
+        return snapshot
+
+    def _load(self, session, item_class):
+        ## Read first, a change during the query makes the snapshot outdated at once
+        version = self.version
+        item_id = inspect(item_class).primary_key[0]
+        items = tuple(session.query(item_class).order_by(item_id))
+        by_key = {}
+        for item in items:
+            by_key.setdefault(item_key(item_class, _values_of(item)), getattr(item, item_id.key))
+        return CatalogSnapshot(version, items,
+                               tuple(item for item in items if item.active),
+                               dict((getattr(item, item_id.key), item) for item in items),
+                               by_key)
+
+    def items(self, session, item_class):
+        return self.snapshot(session, item_class).items
+
+    def active_items(self, session, item_class):
+        return self.snapshot(session, item_class).active_items
+
+    def item(self, session, item_class, item_id):
+        '''The item with the id, None if there is none'''
+        return self.snapshot(session, item_class).by_id.get(item_id)
+
+    def duplicate_id(self, session, item, **values):
+        '''The id of another item of the catalog of item which has the key given by values
+           (the CATALOG_KEY_FIELDS of the catalog), ignoring case. None if there is none
+        '''
+        item_class = type(item)
+        key = item_key(item_class, values)
+        own_id = _id_of(item)
+        ## Like the autoflush of a query: items changed in the session are compared with their new values
+        if any(isinstance(changed, item_class) for changed in chain(session.new, session.dirty)):
+            session.flush()
+
+        snapshot = self._snapshots.get(item_class)
+        if (snapshot is not None) and (snapshot.version == self.version):
+            found_id = snapshot.by_key.get(key)
+            return found_id if (found_id != own_id) else None
+
+        ## Not loaded: look up the name in the index instead of loading the whole catalog
+        candidates = session.query(item_class).filter(func.lower(catalog_name_column(item_class)) == key[0])
+        for candidate in candidates:
+            candidate_id = _id_of(candidate)
+            if (candidate_id != own_id) and (item_key(item_class, _values_of(candidate)) == key):
+                return candidate_id
+        return None
+
+    def invalidate(self):
+        '''Make every loaded catalog outdated'''
+        self.version += 1
+
+    def track(self, session_factory):
+        '''Invalidate the cache on the catalog changes of the sessions made by session_factory'''
+        event.listen(session_factory, 'after_flush', self._after_flush)
+        event.listen(session_factory, 'after_rollback', self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        if any(isinstance(instance, CATALOG_CLASSES)
+               for instance in chain(session.new, session.dirty, session.deleted)):
+            self.invalidate()
+
+    def _after_rollback(self, session):
+        self.invalidate()
@@ -0,0 +1,210 @@
+'''
+Lagged correlations between what was done on a day (sleep, activities, medications,
+treatments) and the pain recorded on the same day and the days after.
+
+All the driver series are stacked into one days x drivers matrix and all the pain
+series into one days x targets matrix, so the coefficients of every (driver, target)
+pair at a lag come out of a few matrix products, instead of one computation per pair.
+Missing days are handled pairwise: a (driver, target) pair uses the days on which both
+values are available, as with pandas.DataFrame.corr.
+
+Spearman coefficients are the Pearson coefficients of the ranks, where each series is
+ranked once over all its available days (not over each pairwise subset); for series
+missing on different days this is a close approximation of the exact value.
+
+Usage: python correlation.py [dbfile] [--max-lag DAYS] [--method pearson|spearman]
+
+Requires numpy.
+'''
+import argparse
+import os.path
+import sys
+
+import numpy as np
+import numpy.ma as ma
+
+from analytics import load_series
+
+## (kind name, series name, label format) of the per-item series used as drivers
+ITEM_DRIVERS = [
+    ('activity', 'minutes', "{} (minutes)"),
+    ('activity', 'intensity', "{} (intensity)"),
+    ('medication', 'quantity', "{} (quantity)"),
+    ('treatment', 'times_per_day', "{} (times)"),
+    ('treatment', 'minutes', "{} (minutes)"),
+]
+
+DEFAULT_MAX_LAG = 7
+DEFAULT_MIN_PERIODS = 10
+
+
+class CorrelationResult(object):
+    '''Coefficients indexed [lag, driver, target], masked where not enough days overlap'''
+
+    def __init__(self, method, lags, driver_labels, target_labels, coefficients, counts):
+        self.method = method
+        self.lags = lags
+        self.driver_labels = driver_labels
+        self.target_labels = target_labels
+        self.coefficients = coefficients
+        self.counts = counts
+
+    def strongest(self, count=20):
+        '''Return the count strongest correlations as (lag, driver label, target label, r, days)'''
+        magnitudes = ma.filled(abs(self.coefficients), -1.0).ravel()
+        count = min(count, int((magnitudes >= 0).sum()))
+        order = np.argsort(-magnitudes, kind='stable')[:count]
+        result = []
+        for lag_index, driver, target in zip(*np.unravel_index(order, self.coefficients.shape)):
+            result.append((int(self.lags[lag_index]), self.driver_labels[driver], self.target_labels[target],
+                           float(self.coefficients[lag_index, driver, target]),
+                           int(self.counts[lag_index, driver, target])))
+        return result
+
+
+def drivers_and_targets(series):
+    '''Stack the driver and target series of a DiarySeries into two (masked matrix, labels)'''
+    driver_columns = [series['sleep_minutes'], series['sleep_quality']]
+    driver_labels = ["sleep (minutes)", "sleep quality"]
+    for kind_name, name, label_format in ITEM_DRIVERS:
+        items = series.items[(kind_name, name)]
+        driver_columns.append(items.values)
+        driver_labels.extend(label_format.format(label) for label in items.labels)
+
+    sites = series.items[('pain_site', 'painlevel')]
+    target_columns = [series['average_pain'], series['max_pain'], sites.values]
+    target_labels = ["average pain", "max pain"] + ["pain: {}".format(label) for label in sites.labels]
+
+    def stack(columns):
+        return ma.column_stack([column.reshape(len(series), -1) for column in columns])
+    return (stack(driver_columns), driver_labels), (stack(target_columns), target_labels)
+
+
+def _average_ranks(values):
+    '''Ranks of the unmasked values of each column (1-based, ties averaged), masked elsewhere'''
+    data = ma.getdata(values).astype(float)
+    valid = ~ma.getmaskarray(values)
+    ranks = np.full(data.shape, np.nan)
+    for column in range(data.shape[1]):
+        rows = np.flatnonzero(valid[:, column])
+        if len(rows) == 0:
+            continue
+        column_values = data[rows, column]
+        order = np.argsort(column_values, kind='stable')
+        sorted_values = column_values[order]
+        ## start of each run of equal values, the run shares the average of its ranks
+        run_starts = np.flatnonzero(np.r_[True, sorted_values[1:] != sorted_values[:-1]])
+        run_ends = np.r_[run_starts[1:], len(sorted_values)]
+        run_ranks = (run_starts + run_ends + 1) / 2.0
+        column_ranks = np.empty(len(rows))
+        column_ranks[order] = np.repeat(run_ranks, run_ends - run_starts)
+        ranks[rows, column] = column_ranks
+    return ma.masked_invalid(ranks)
+
+
+def _unique_columns(valid):
+    '''Return (distinct columns, index of the distinct column of each column) of a boolean matrix'''
+    packed = np.packbits(valid, axis=0)
+    _, first, inverse = np.unique(packed.T, axis=0, return_index=True, return_inverse=True)
+    return valid[:, first], inverse.ravel()
+
+
+def lagged_correlations(drivers, targets, max_lag=DEFAULT_MAX_LAG, method='pearson',
+                        min_periods=DEFAULT_MIN_PERIODS):
+    '''Correlations of drivers on day t with targets on day t + lag, for lag in 0..max_lag.
+       drivers and targets are days x columns masked arrays over the same days.
+       Returns (coefficients, counts) arrays of shape (lags, drivers, targets), the
+       coefficients masked where fewer than min_periods days overlap or a series is constant.
+    '''
+    if method == 'spearman':
+        drivers = _average_ranks(drivers)
+        targets = _average_ranks(targets)
+    elif method != 'pearson':
+        raise ValueError("Unknown correlation method %s, must be pearson or spearman" % method)
+
+    drivers_valid = ~ma.getmaskarray(drivers)
+    targets_valid = ~ma.getmaskarray(targets)
+    ## Centering on the overall means keeps the sums small, the coefficients don't change
+    x = np.where(drivers_valid, ma.getdata(drivers) - ma.mean(drivers, axis=0).filled(0.0), 0.0)
+    y = np.where(targets_valid, ma.getdata(targets) - ma.mean(targets, axis=0).filled(0.0), 0.0)
+    ## The sums over the days where the driver is valid only depend on which days those are,
+    ## and most drivers (the doses and durations, 0 when not recorded) are valid on the same days
+    distinct_valid, distinct_of_driver = _unique_columns(drivers_valid)
+    distinct_valid = distinct_valid.astype(float)
+    x_and_squares = np.hstack([x, x * x])
+    y_valid = targets_valid.astype(float)
+    y_sums = np.hstack([y_valid, y, y * y])
+
+    days, driver_count = x.shape
+    target_count = y.shape[1]
+    lags = np.arange(max_lag + 1)
+    shape = (len(lags), driver_count, target_count)
+    coefficients = np.zeros(shape)
+    counts = np.zeros(shape, dtype='i8')
+    invalid = np.ones(shape, dtype=bool)
+    for lag in lags[lags < days]:
+        end = days - lag
+        sums_of_x = x_and_squares[:end].T @ y_valid[lag:]
+        sum_x, sum_xx = sums_of_x[:driver_count], sums_of_x[driver_count:]
+        sum_xy = x[:end].T @ y[lag:]
+        sums_of_y = (distinct_valid[:end].T @ y_sums[lag:])[distinct_of_driver]
+        lag_counts = sums_of_y[:, :target_count]
+        sum_y = sums_of_y[:, target_count:2 * target_count]
+        sum_yy = sums_of_y[:, 2 * target_count:]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            covariance = lag_counts * sum_xy - sum_x * sum_y
+            variance_x = lag_counts * sum_xx - sum_x * sum_x
+            variance_y = lag_counts * sum_yy - sum_y * sum_y
+            coefficients[lag] = np.clip(covariance / np.sqrt(variance_x * variance_y), -1.0, 1.0)
+        ## rounding can leave constant series with a tiny non-zero variance
+        degenerate = ((variance_x <= 1e-9 * np.maximum(lag_counts * sum_xx, 1.0))
+                      | (variance_y <= 1e-9 * np.maximum(lag_counts * sum_yy, 1.0)))
+        invalid[lag] = (lag_counts < min_periods) | degenerate | ~np.isfinite(coefficients[lag])
+        counts[lag] = np.rint(lag_counts)
+    return ma.masked_array(coefficients, mask=invalid), counts
+
+
+def correlate(series, max_lag=DEFAULT_MAX_LAG, method='pearson', min_periods=DEFAULT_MIN_PERIODS):
+    '''Lagged correlations of sleep, activities, medications and treatments with pain, for a DiarySeries'''
+    (drivers, driver_labels), (targets, target_labels) = drivers_and_targets(series)
+    coefficients, counts = lagged_correlations(drivers, targets, max_lag, method, min_periods)
+    return CorrelationResult(method, np.arange(max_lag + 1), driver_labels, target_labels,
+                             coefficients, counts)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Lagged correlations of sleep, activities, "
+                                                 "medications and treatments with pain")
+    parser.add_argument('dbfile', nargs='?', default=None,
+                        help="Diary DB file. Defaults to data/entries.db in the script directory")
+    parser.add_argument('--max-lag', type=int, default=DEFAULT_MAX_LAG,
+                        help="Largest number of days between driver and pain (default %(default)s)")
+    parser.add_argument('--method', choices=['pearson', 'spearman'], default='pearson')
+    parser.add_argument('--min-days', type=int, default=DEFAULT_MIN_PERIODS,
+                        help="Fewest days with both values for a coefficient (default %(default)s)")
+    parser.add_argument('--top', type=int, default=20, help="Number of correlations to show (default %(default)s)")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    from sqlalchemy import create_engine
+
+    args = parse_args(argv)
+    if args.dbfile is not None:
+        db_file = os.path.realpath(args.dbfile)
+    else:
+        db_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data", "entries.db")
+    engine = create_engine(f"sqlite:///{db_file}")
+    try:
+        with engine.connect() as connection:
+            series = load_series(connection)
+    finally:
+        engine.dispose()
+    result = correlate(series, args.max_lag, args.method, args.min_days)
+    print("{:>3}  {:<40} {:<30} {:>7} {:>6}".format("lag", "driver", "pain", "r", "days"))
+    for lag, driver, target, coefficient, days in result.strongest(args.top):
+        print("{:>3}  {:<40} {:<30} {:>7.3f} {:>6d}".format(lag, driver, target, coefficient, days))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
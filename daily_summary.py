@@ -0,0 +1,86 @@
+'''
+Maintenance of the daily_summary table (data.DailySummary): one row per record with its
+pain levels, symptom count, activity and treatment minutes, medication doses and sleep.
+
+track_daily_summaries hooks a session so that every flush touching a record or any of
+its details recomputes the summary rows of those records, with one INSERT ... SELECT in
+the same transaction, so the summaries are committed together with the details.
+rebuild_daily_summaries recomputes the whole table, e.g. for files written by older
+versions or by bulk inserts which bypass the session.
+'''
+from sqlalchemy import event
+
+from data import Record, PainInfo, SleepInfo, DailySummary, DETAIL_KINDS
+
+## Classes whose rows feed the summary of their record, all of them have record_id
+SUMMARIZED_CLASSES = (Record, PainInfo, SleepInfo) + tuple(kind.detail_class for kind in DETAIL_KINDS.values())
+
+## Keeps the number of bound parameters well under the SQLite limit
+_CHUNK_SIZE = 500
+
+_SUMMARY_SELECT = """
+SELECT e.record_id, e.date_entered,
+       p.averagepain, p.maxpain,
+       (SELECT MAX(painlevel) FROM paindetail WHERE record_id = e.record_id),
+       (SELECT COUNT(*) FROM symptomdetail WHERE record_id = e.record_id AND intensity > 0),
+       (SELECT COALESCE(SUM(COALESCE(hours, 0) * 60 + COALESCE(minutes, 0)), 0)
+          FROM activitydetail WHERE record_id = e.record_id),
+       (SELECT COALESCE(SUM(COALESCE(hours, 0) * 60 + COALESCE(minutes, 0)), 0)
+          FROM treatmentdetail WHERE record_id = e.record_id),
+       (SELECT COALESCE(SUM(quantity), 0) FROM medicationdetail WHERE record_id = e.record_id),
+       s.hours * 60 + s.minutes
+  FROM entries e
+  LEFT JOIN painlevel p ON p.record_id = e.record_id
+  LEFT JOIN sleep s ON s.record_id = e.record_id
+"""
+
+_SUMMARY_INSERT = ("INSERT OR REPLACE INTO daily_summary (record_id, date_entered, average_pain, max_pain, "
+                   "max_site_pain, symptom_count, activity_minutes, treatment_minutes, medication_doses, "
+                   "sleep_minutes)")
+
+
+def refresh_daily_summaries(connection, record_ids):
+    '''Recompute the summary rows of the given records, dropping those of records which no longer exist'''
+    record_ids = sorted(set(record_ids))
+    for start in range(0, len(record_ids), _CHUNK_SIZE):
+        chunk = tuple(record_ids[start:start + _CHUNK_SIZE])
+        placeholders = ", ".join("?" * len(chunk))
+        connection.exec_driver_sql("DELETE FROM daily_summary WHERE record_id IN (%s)" % placeholders, chunk)
+        connection.exec_driver_sql("%s %s WHERE e.record_id IN (%s)" % (_SUMMARY_INSERT, _SUMMARY_SELECT, placeholders),
+                                   chunk)
+
+
+def rebuild_daily_summaries(connection):
+    '''Recompute the whole daily_summary table. Returns the number of rows'''
+    connection.exec_driver_sql("DELETE FROM daily_summary")
+    return connection.exec_driver_sql("%s %s" % (_SUMMARY_INSERT, _SUMMARY_SELECT)).rowcount
+
+
+def _touched_record_ids(session):
+    record_ids = set()
+    for instances in (session.new, session.dirty, session.deleted):
+        for instance in instances:
+            if isinstance(instance, SUMMARIZED_CLASSES) and (instance.record_id is not None):
+                record_ids.add(instance.record_id)
+    return record_ids
+
+
+def _after_flush(session, flush_context):
+    ## At this point the new objects have their keys, and new/dirty/deleted still list what was flushed
+    record_ids = _touched_record_ids(session)
+    if record_ids:
+        refresh_daily_summaries(session.connection(), record_ids)
+
+
+def track_daily_summaries(session_factory):
+    '''Keep daily_summary up to date in the sessions made by session_factory (a sessionmaker or scoped_session)'''
+    event.listen(session_factory, 'after_flush', _after_flush)
+
+
+def load_daily_summaries(session, start_date, end_date):
+    '''Return the DailySummary rows of the dates between start_date and end_date (inclusive), by date'''
+    return session.query(DailySummary)\
+                  .filter(DailySummary.date_entered >= start_date)\
+                  .filter(DailySummary.date_entered <= end_date)\
+                  .order_by(DailySummary.date_entered)\
+                  .all()
@@ -4,9 +4,11 @@ from sqlalchemy import Column, String
 from sqlalchemy.dialects.sqlite import INTEGER as Integer 
 from sqlalchemy.dialects.sqlite import DATE as Date, TIME as Time, BOOLEAN as Boolean
 
-from sqlalchemy import ForeignKey
-from sqlalchemy.orm import relationship, backref
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy import ForeignKey, and_, or_, inspect, func
+from sqlalchemy.orm import relationship, backref, joinedload, selectinload, configure_mappers
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.schema import UniqueConstraint, Index
+from sqlalchemy.dialects.sqlite import insert
 import sys
 
 
@@ -56,12 +58,16 @@ class PainSite(Base):
 
 class PainSiteInfo(Base):
     __tablename__ = 'paindetail'
+    __table_args__ = (
+            ## For per-item time series across records
+            Index('ix_paindetail_site_id_record', 'site_id', 'record_id'),
+        )
     record_id = Column(Integer, ForeignKey("entries.record_id"), primary_key=True)
     site_id = Column(Integer, ForeignKey("painsite.site_id"), primary_key=True)
     painlevel = Column(Integer)
 
     record = relationship("Record", backref=backref('pain_site_info'))
-    site = relationship("PainSite")
+    site = relationship("PainSite", lazy='joined')
  
                       
     def __init__(self, record_id, site_id, painlevel=None):
@@ -88,13 +94,17 @@ class Symptom(Base):
 
 class SymptomInfo(Base):
     __tablename__ = 'symptomdetail'
+    __table_args__ = (
+            ## For per-item time series across records
+            Index('ix_symptomdetail_symptom_id_record', 'symptom_id', 'record_id'),
+        )
 
     record_id = Column(Integer, ForeignKey("entries.record_id"), primary_key=True)
     symptom_id = Column(Integer, ForeignKey("symptom.symptom_id"), primary_key=True)
     intensity = Column(Integer)
 
     record = relationship("Record", backref=backref('symptom_info'))
-    symptom = relationship("Symptom")
+    symptom = relationship("Symptom", lazy='joined')
 
     def __init__(self, record_id, symptom_id, intensity):
         self.record_id = record_id
@@ -131,13 +141,17 @@ class Medication(Base):
 
 class MedicationInfo(Base):
     __tablename__ = 'medicationdetail'
+    __table_args__ = (
+            ## For per-item time series across records
+            Index('ix_medicationdetail_medication_id_record', 'medication_id', 'record_id'),
+        )
 
     record_id = Column(Integer, ForeignKey("entries.record_id"), primary_key=True)
     medication_id = Column(Integer, ForeignKey("medication.medication_id"), primary_key=True)
     quantity = Column(Integer, nullable=False)
 
     record = relationship("Record", backref=backref('medication_info'))
-    medication = relationship("Medication")
+    medication = relationship("Medication", lazy='joined')
 
     def __init__(self, record_id, medication_id, quantity):
         self.record_id = record_id
@@ -167,6 +181,10 @@ class Treatment(Base):
 
 class TreatmentInfo(Base):
     __tablename__ = 'treatmentdetail'
+    __table_args__ = (
+            ## For per-item time series across records
+            Index('ix_treatmentdetail_treatment_id_record', 'treatment_id', 'record_id'),
+        )
 
     record_id = Column(Integer, ForeignKey("entries.record_id"), primary_key=True)
     treatment_id = Column(Integer, ForeignKey("treatment.treatment_id"), primary_key=True)
@@ -175,7 +193,7 @@ class TreatmentInfo(Base):
     minutes = Column(Integer)
 
     record = relationship("Record", backref=backref('treatment_info'))
-    treatment = relationship("Treatment")
+    treatment = relationship("Treatment", lazy='joined')
 
     def __init__(self, record_id, treatment_id, times_per_day=None, hours=None, minutes=None):
         self.record_id = record_id
@@ -203,6 +221,10 @@ class Activity(Base):
 
 class ActivityInfo(Base):
     __tablename__ = 'activitydetail'
+    __table_args__ = (
+            ## For per-item time series across records
+            Index('ix_activitydetail_activity_id_record', 'activity_id', 'record_id'),
+        )
 
     record_id = Column(Integer, ForeignKey("entries.record_id"), primary_key=True)
     activity_id = Column(Integer, ForeignKey("activity.activity_id"), primary_key=True)
@@ -213,7 +235,7 @@ class ActivityInfo(Base):
     intensity = Column(Integer)
 
     record = relationship("Record", backref=backref('activity_info'))
-    activity = relationship("Activity")
+    activity = relationship("Activity", lazy='joined')
 
     def __init__(self, record_id=None, activity_id=None, hours=None, minutes=None, intensity=None):
         self.record_id = record_id
@@ -245,3 +267,295 @@ class SleepInfo(Base):
         self.light_out_time = light_out_time
         self.awake_time = awake_time
         self.asleep_time = asleep_time
+
+
+class DailySummary(Base):
+    '''The numbers of one record, denormalized from its details into one narrow row.
+       Derived data, kept up to date by daily_summary.track_daily_summaries
+       and rebuilt with "python maintenance.py summarize".
+    '''
+    __tablename__ = 'daily_summary'
+
+    ## No foreign key: the row is replaced or dropped after its record changes, in the same flush
+    record_id = Column(Integer, primary_key=True)
+    date_entered = Column(Date, nullable=False, index=True)
+    average_pain = Column(Integer)
+    max_pain = Column(Integer)
+    max_site_pain = Column(Integer)
+    symptom_count = Column(Integer, nullable=False, default=0)
+    activity_minutes = Column(Integer, nullable=False, default=0)
+    treatment_minutes = Column(Integer, nullable=False, default=0)
+    medication_doses = Column(Integer, nullable=False, default=0)
+    sleep_minutes = Column(Integer)
+
+
+## Case-insensitive lookups of catalog items by name, see catalog_cache.CatalogCache.duplicate_id
+Index('ix_painsite_lower_location', func.lower(PainSite.location))
+Index('ix_symptom_lower_name', func.lower(Symptom.name))
+Index('ix_medication_lower_name', func.lower(Medication.name))
+Index('ix_treatment_lower_name', func.lower(Treatment.name))
+Index('ix_activity_lower_name', func.lower(Activity.name))
+
+
+class SchemaMeta(Base):
+    '''Facts about the schema of the file, by name. See migrations.upgrade_schema'''
+    __tablename__ = 'schema_meta'
+
+    name = Column(String, primary_key=True)
+    value = Column(String)
+
+
+def find_entry_dates(session, start_date, end_date):
+    '''Return the set of dates between start_date and end_date (inclusive) that have an entry.
+       Uses a single query over the unique index on date_entered, however long the range is.
+    '''
+    entry_query = session.query(Record.date_entered)\
+                         .filter(Record.date_entered >= start_date)\
+                         .filter(Record.date_entered <= end_date)
+    return set(result.date_entered for result in entry_query)
+
+
+def record_detail_options():
+    '''Loader options fetching a record together with its whole detail graph.
+       One-to-one details are joined into the record query, each detail collection is
+       loaded with one extra "SELECT ... WHERE record_id IN (...)", and the catalog items are
+       joined into those (the relationships to catalog classes are configured as lazy='joined').
+       The number of queries is fixed, independent of catalog size.
+    '''
+    ## The backref attributes on Record only exist once the mappers are configured
+    configure_mappers()
+    return (joinedload(Record.pain_info),
+            joinedload(Record.sleep_info),
+            selectinload(Record.pain_site_info),
+            selectinload(Record.symptom_info),
+            selectinload(Record.medication_info),
+            selectinload(Record.treatment_info),
+            selectinload(Record.activity_info))
+
+
+def load_record_with_details(session, date):
+    '''Find the record for the date, with all its details eagerly loaded. Returns None if there is no such record'''
+    entry_query = session.query(Record).options(*record_detail_options())\
+                         .filter(Record.date_entered == date)
+    try:
+        return entry_query.one()
+    except NoResultFound:
+        return None
+
+
+def find_record_by_date(session, date):
+    '''Find the record for the date, None if there is no such record'''
+    entry_query = session.query(Record).filter(Record.date_entered == date)
+    try:
+        return entry_query.one()
+    except NoResultFound:
+        return None
+
+
+def load_entry_dates(session):
+    '''Return the dates of all the entries, in a list'''
+    return [result.date for result in session.query(Record.date_entered.label('date'))]
+
+
+def catalog_name_column(item_class):
+    '''The column the items of a catalog are listed and searched by'''
+    if (item_class is PainSite):
+        return PainSite.location
+    return item_class.name
+
+
+def catalog_page_key(item_class, item):
+    '''The (name, id) position of a catalog item of item_class, or of a DetachedCopy of one,
+       in the order of catalog_page
+    '''
+    return (getattr(item, catalog_name_column(item_class).key),
+            getattr(item, inspect(item_class).primary_key[0].key))
+
+
+def catalog_page(session, item_class, after=None, limit=50, active_only=False, name_prefix=None):
+    '''A page of at most limit catalog items ordered by name, then id, starting after the
+       catalog_page_key "after" of the last item of the previous page. The filters are applied
+       in SQL, so the cost of a page depends on its size, not on the size of the catalog.
+    '''
+    name = catalog_name_column(item_class)
+    item_id = inspect(item_class).primary_key[0]
+    items_query = session.query(item_class)
+    if active_only:
+        items_query = items_query.filter(item_class.active == True)
+    if name_prefix:
+        items_query = items_query.filter(name.startswith(name_prefix, autoescape=True))
+    if (after is not None):
+        last_name, last_id = after
+        items_query = items_query.filter(or_(name > last_name, and_(name == last_name, item_id > last_id)))
+    return items_query.order_by(name, item_id).limit(limit).all()
+
+
+def upsert_statement(table, key_columns, value_columns, keep_existing=False):
+    '''An INSERT of one row per parameter set, updating the value_columns of an existing row
+       with the same key instead. With keep_existing, NULL values leave the existing values as they are
+    '''
+    statement = insert(table)
+    if keep_existing:
+        values = dict((column, func.coalesce(getattr(statement.excluded, column), table.c[column]))
+                      for column in value_columns)
+    else:
+        values = dict((column, getattr(statement.excluded, column)) for column in value_columns)
+    return statement.on_conflict_do_update(index_elements=key_columns, set_=values)
+
+
+class DetachedCopy(object):
+    '''A plain copy of the column values of a mapped object, and of the objects of the given
+       relationships, which belongs to no session. The DB worker returns these to the GUI thread,
+       which may read and change them without touching the session
+    '''
+
+    def __init__(self, instance, relations=()):
+        self.mapped_class = type(instance)
+        ## The primary key of the object in a tuple, None for an object which is not in the DB,
+        ## e.g. a virtual detail (see details_for_editing) or a new catalog item
+        self.identity = inspect(instance).identity
+        for attribute in inspect(self.mapped_class).column_attrs:
+            setattr(self, attribute.key, getattr(instance, attribute.key))
+        for relation in relations:
+            related = getattr(instance, relation)
+            setattr(self, relation, DetachedCopy(related) if (related is not None) else None)
+
+    def values(self, fields=None):
+        '''{field: value} of the given fields, by default of all the columns but the primary key'''
+        if (fields is None):
+            mapper = inspect(self.mapped_class)
+            fields = [attribute.key for attribute in mapper.column_attrs
+                      if not any(column.primary_key for column in attribute.columns)]
+        return dict((field, getattr(self, field)) for field in fields)
+
+
+class DetailKind(object):
+    '''Describes a kind of per-record detail linked to a catalog of items, e.g. symptoms'''
+
+    def __init__(self, name, detail_class, item_class, item_key, item_relation, collection,
+                 placeholder_values, empty_values):
+        self.name = name
+        self.detail_class = detail_class
+        self.item_class = item_class
+        ## Name of the item id attribute, the same in the catalog class and in the detail class
+        self.item_key = item_key
+        ## Name of the relationship from the detail to its catalog item
+        self.item_relation = item_relation
+        ## Name of the collection of details on Record
+        self.collection = collection
+        ## Function returning a dict of the detail values shown for an item that was not recorded yet
+        self.placeholder_values = placeholder_values
+        ## For each value field, the values that mean "nothing recorded".
+        ## A detail is empty when all its fields have one of those
+        self.empty_values = empty_values
+
+    def details_of(self, record):
+        return getattr(record, self.collection)
+
+    @property
+    def value_fields(self):
+        return tuple(self.empty_values)
+
+    def is_empty(self, detail):
+        return all(getattr(detail, field) in values for field, values in self.empty_values.items())
+
+    def empty_condition(self):
+        '''SQL condition matching the empty detail rows'''
+        conditions = []
+        for field, values in self.empty_values.items():
+            column = self.detail_class.__table__.c[field]
+            field_conditions = []
+            if None in values:
+                field_conditions.append(column.is_(None))
+            other_values = [value for value in values if value is not None]
+            if other_values:
+                field_conditions.append(column.in_(other_values))
+            conditions.append(or_(*field_conditions))
+        return and_(*conditions)
+
+
+DETAIL_KINDS = {
+    'pain_site': DetailKind('pain_site', PainSiteInfo, PainSite, 'site_id', 'site', 'pain_site_info',
+                            lambda item: {'painlevel': None},
+                            {'painlevel': (None,)}),
+    'symptom': DetailKind('symptom', SymptomInfo, Symptom, 'symptom_id', 'symptom', 'symptom_info',
+                          lambda item: {'intensity': None},
+                          {'intensity': (None,)}),
+    ## An unrecorded medication starts at its usual quantity, but is only saved if the user enters
+    ## a quantity for it (see MedicationDetailEditBlock), 0 meaning it was not taken
+    'medication': DetailKind('medication', MedicationInfo, Medication, 'medication_id', 'medication', 'medication_info',
+                             lambda item: {'quantity': item.quantity},
+                             {'quantity': (None, 0)}),
+    'treatment': DetailKind('treatment', TreatmentInfo, Treatment, 'treatment_id', 'treatment', 'treatment_info',
+                            ## times_per_day is NOT NULL in the table, so it starts at its default
+                            lambda item: {'times_per_day': 0, 'hours': None, 'minutes': None},
+                            {'times_per_day': (None, 0), 'hours': (None, 0), 'minutes': (None, 0)}),
+    'activity': DetailKind('activity', ActivityInfo, Activity, 'activity_id', 'activity', 'activity_info',
+                           lambda item: {'hours': 0, 'minutes': 0, 'intensity': None},
+                           {'hours': (None, 0), 'minutes': (None, 0), 'intensity': (None,)}),
+}
+
+
+def details_for_editing(session, record, kind_name, catalog_cache=None):
+    '''Return the details of the record, sorted by item, with a virtual detail for every active
+       catalog item not recorded yet. Virtual details are not added to the session, they are
+       only saved (see edited_detail_values) if the user changes them.
+       The active items are taken from catalog_cache (a catalog_cache.CatalogCache) if it is given.
+    '''
+    kind = DETAIL_KINDS[kind_name]
+    details = list(kind.details_of(record))
+    recorded_ids = set(getattr(detail, kind.item_key) for detail in details)
+
+    if (catalog_cache is not None):
+        items = [item for item in catalog_cache.active_items(session, kind.item_class)
+                 if getattr(item, kind.item_key) not in recorded_ids]
+    else:
+        item_id = getattr(kind.item_class, kind.item_key)
+        items = session.query(kind.item_class).filter(kind.item_class.active == True)
+        if recorded_ids:
+            items = items.filter(~item_id.in_(recorded_ids))
+
+    for item in items:
+        values = kind.placeholder_values(item)
+        values[kind.item_key] = getattr(item, kind.item_key)
+        detail = kind.detail_class(record_id=record.record_id, **values)
+        ## The relationship has no backref, so this does not put the detail in the session
+        setattr(detail, kind.item_relation, item)
+        details.append(detail)
+
+    details.sort(key=lambda detail: getattr(detail, kind.item_key))
+    return details
+
+
+def edited_detail_values(kind_name, details, edited_ids=None):
+    '''The mapping of DiaryStore.set_details saving details (DetachedCopies of details_for_editing)
+       as they were edited: the recorded details, deleted if they were emptied, and the virtual
+       details the user changed. edited_ids are the item ids of the virtual details the user
+       changed; if it is not given, those whose values differ from their placeholder values
+    '''
+    kind = DETAIL_KINDS[kind_name]
+    mapping = {}
+    for detail in details:
+        item_id = getattr(detail, kind.item_key)
+        values = detail.values(kind.value_fields)
+        if (detail.identity is not None):
+            mapping[item_id] = None if kind.is_empty(detail) else values
+        elif kind.is_empty(detail):
+            continue
+        elif (edited_ids is not None):
+            if (item_id in edited_ids):
+                mapping[item_id] = values
+        elif (values != kind.placeholder_values(getattr(detail, kind.item_relation))):
+            mapping[item_id] = values
+    return mapping
+
+
+def delete_empty_details(session):
+    '''Delete all the detail rows holding no data, e.g. placeholders created by older versions.
+       Returns the number of rows deleted for each kind of detail.
+    '''
+    deleted = {}
+    for kind_name, kind in DETAIL_KINDS.items():
+        result = session.execute(kind.detail_class.__table__.delete().where(kind.empty_condition()))
+        deleted[kind_name] = result.rowcount
+    return deleted
@@ -25,7 +25,8 @@ from diary_widgets import ColorLabel
 from kivy.uix.popup import Popup
 
 class DatePickerButton(Button):
-    pass
+    ## The date of the day cell, None for the cells outside of the month
+    date = kyprops.ObjectProperty(None, allownone=True)
 
 
 class DatePicker(BoxLayout):
@@ -50,6 +51,10 @@ class DatePicker(BoxLayout):
     
     body = kyprops.ObjectProperty()
 
+    ## Enough weeks for any month
+    grid_weeks = 6
+    ## The 7 x grid_weeks day cells, built once and reused for every month
+    day_cells = None
 
     
     def __init__(self, **kwargs):
@@ -73,46 +78,59 @@ class DatePicker(BoxLayout):
 
     
 
-    def populate_body(self):
-        self.body.clear_widgets()    
-        application = App.get_running_app()
-        
-        first_weekday, numdays = monthrange(self.month_start.year, self.month_start.month) 
-        today = date.today()
-
-        # first we will put in a header with appropriately initialized weekdays
+    def build_grid(self):
+        '''Create the weekday headers and the day cells. Called once, populate_body then only updates them'''
         for dayname in calendar.day_abbr:
             self.body.add_widget(ColorLabel(text=dayname,
                                        background_color=self.background_header,
                                        size_hint = (0.5, 0.99)
                                        ))
-            
+        self.day_cells = []
+        for index in range(7 * self.grid_weeks):
+            day_cell = DatePickerButton()
+            day_cell.bind(on_press=self.day_cell_pressed)
+            self.body.add_widget(day_cell)
+            self.day_cells.append(day_cell)
+
+    def day_cell_pressed(self, day_cell):
+        if (day_cell.date is not None):
+            self.date_clicked(day_cell.date)
+
+    def populate_body(self):
+        if (self.day_cells is None):
+            self.build_grid()
+        application = App.get_running_app()
         
-        # filler fields from previous month, empty
-        for filler in range(first_weekday):
-            self.body.add_widget(Label(text=""))
-
-
-        for day in range(1, numdays + 1):
-            day_button = DatePickerButton(text = str(day))
-            button_date = date(day=day, 
-                               month=self.month_start.month,
-                               year=self.month_start.year)
-            day_button.bind(on_press=lambda instance, bd=button_date: 
-                                self.date_clicked(bd)
-                                )
+        first_weekday, numdays = monthrange(self.month_start.year, self.month_start.month) 
+        today = date.today()
+        # read from the in-memory entry index, no DB access
+        entry_dates = application.find_entry_dates_in_month(self.month_start)
+
+        for index, day_cell in enumerate(self.day_cells):
+            day = index - first_weekday + 1
+            if (day < 1) or (day > numdays):
+                # filler cells before and after the month, hidden
+                day_cell.date = None
+                day_cell.text = ""
+                day_cell.disabled = True
+                day_cell.opacity = 0
+                continue
+
+            button_date = self.month_start.replace(day=day)
+            day_cell.date = button_date
+            day_cell.text = str(day)
+            day_cell.disabled = False
+            day_cell.opacity = 1
                                            
             if (today == button_date):
-                day_button.border = self.border_today
+                day_cell.border = self.border_today
             else:
-                day_button.border = self.border_default
+                day_cell.border = self.border_default
                 
-            if (application.find_entry_by_date(button_date) is not None):
-                day_button.background_color = self.background_defined
+            if (button_date in entry_dates):
+                day_cell.background_color = self.background_defined
             else:
-                day_button.background_color = self.background_undefined
-                                
-            self.body.add_widget(day_button)
+                day_cell.background_color = self.background_undefined
 
 
     def date_clicked(self, date):
@@ -120,10 +138,10 @@ class DatePicker(BoxLayout):
         
         print(sys.stderr, f"Date clicked {date}")
         application = App.get_running_app()
-        entry = application.find_entry_by_date(date)
+        has_entry = application.has_entry(date)
         
-        print('omg', application, date, entry)
-        if (entry is None):
+        print('omg', application, date, has_entry)
+        if (not has_entry):
             print('ohh')
             self.create_entry_dialog(application=application, date=date)
             print('ahhhh')
@@ -150,14 +168,16 @@ class DatePicker(BoxLayout):
         self.current_month_text = self.makeHeaderText(self.month_start)
         
     def move_next_month(self):
-        self.month_start += timedelta(days = monthrange(self.month_start.year, self.month_start.month)[1])
-        self.populate()
+        with App.get_running_app().instrumentation.action('month navigation'):
+            self.month_start += timedelta(days = monthrange(self.month_start.year, self.month_start.month)[1])
+            self.populate()
 
     def move_previous_month(self):
-        self.month_start += timedelta(days = -1)
-        ## we are now at the end of previous month -- move to start
-        self.month_start = self.month_start.replace(day=1)
-        self.populate()
+        with App.get_running_app().instrumentation.action('month navigation'):
+            self.month_start += timedelta(days = -1)
+            ## we are now at the end of previous month -- move to start
+            self.month_start = self.month_start.replace(day=1)
+            self.populate()
 
 
 class CreateEntryPopup(Popup):
@@ -0,0 +1,84 @@
+'''
+A background thread which owns the database session of the application.
+
+Operations are functions taking the session as their first argument. submit() queues
+one and returns a concurrent.futures.Future; the callback and errback given to it are
+called with the result or the exception through the dispatch function, which in the
+application hands them to the Kivy main loop. Operations run one at a time, in the order
+they were submitted, so an operation always sees the changes of the ones before it.
+
+Objects which hold the session themselves, like a diary_store.DiaryStore whose session
+the worker made (pass its open_session as the session factory), have their methods
+queued with call(). run() and call_and_wait() wait for the result instead, blocking the
+caller; the application only does so while it starts.
+
+The objects of the session must only be used by operations. The operations given to
+the worker by the GUI take plain values and return plain values or data.DetachedCopy
+objects, which the GUI thread may read and change freely.
+'''
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _call_directly(callback):
+    callback()
+
+
+def _without_session(method):
+    '''The operation calling method(*args), for a method which has the session already'''
+    return lambda session, *args: method(*args)
+
+
+class DBWorker(object):
+    def __init__(self, session_factory, dispatch=None, instrumentation=None):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-worker')
+        ## Made on the worker thread, like everything done with it later
+        self.session = self._executor.submit(session_factory).result()
+        self._dispatch = dispatch if (dispatch is not None) else _call_directly
+        self._instrumentation = instrumentation
+
+    def _run(self, operation, args, action):
+        try:
+            if (action is not None) and (self._instrumentation is not None):
+                with self._instrumentation.action(action):
+                    return operation(self.session, *args)
+            return operation(self.session, *args)
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def submit(self, operation, *args, callback=None, errback=None, action=None):
+        '''Queue operation(session, *args). callback(result) or errback(exception) are then
+           called through the dispatch function. action names the operation for the query
+           instrumentation. Returns the future of the result
+        '''
+        future = self._executor.submit(self._run, operation, args, action)
+        future.add_done_callback(lambda done: self._dispatch(lambda: self._deliver(done, callback, errback)))
+        return future
+
+    def _deliver(self, future, callback, errback):
+        error = future.exception()
+        if (error is None):
+            if (callback is not None):
+                callback(future.result())
+        elif (errback is not None):
+            errback(error)
+        else:
+            print("Database operation failed: {!r}".format(error), file=sys.stderr)
+
+    def run(self, operation, *args, action=None):
+        '''Run operation(session, *args) on the worker and wait for its result'''
+        return self._executor.submit(self._run, operation, args, action).result()
+
+    def call(self, method, *args, callback=None, errback=None, action=None):
+        '''Like submit, for method(*args), a method using the worker's session by itself'''
+        return self.submit(_without_session(method), *args, callback=callback, errback=errback, action=action)
+
+    def call_and_wait(self, method, *args, action=None):
+        '''Like run, for method(*args), a method using the worker's session by itself'''
+        return self.run(_without_session(method), *args, action=action)
+
+    def shutdown(self):
+        '''Finish the queued operations and close the session'''
+        self._executor.submit(self.session.close).result()
+        self._executor.shutdown(wait=True)
@@ -1,16 +1,27 @@
 from kivy.uix.boxlayout import BoxLayout
 from kivy.properties import StringProperty, ObjectProperty, BooleanProperty
+from kivy.clock import Clock
 from kivy.uix.popup import Popup
 from main import SymptomDiaryApp
+from data import edited_detail_values, catalog_page_key
+from diary_widgets import ErrorPopup, load_rules_once, label_pool
 import sys
 #from kivy.adapters.listadapter import ListAdapter
 from kivy.uix.recycleview import RecycleView
 
+## The rules of the editors, loaded when the first one is opened
+EDITOR_RULES = 'kv/entryedit.kv'
+
 
 class InfoBlock(BoxLayout):
+    ## The record shown, a data.DetachedCopy made by DiaryStore.entry_snapshot
     record = None    
+    ## Key of the block's summary in the summaries of the record, None if it has none
+    summary_key = None
     main_content = ObjectProperty()
     content_label = StringProperty()
+    ## True while the record is loaded or saved by the DB worker
+    loading = BooleanProperty(False)
         
     def add_widget(self, widget, index=0):        
         if (self.main_content is None) and not (hasattr(widget, 'shared_content') and (widget.shared_content)):
@@ -23,13 +34,14 @@ class InfoBlock(BoxLayout):
                                                                           
     def fill_in(self, record):
         self.record = record
+        self.loading = False
         self.update_info()
         
-    def _handle_save_finished(self):
-        app = SymptomDiaryApp.get_running_app()
-        session = app.getDBSession()
-        session.commit()        
-        self.update_info()
+    def summary(self):
+        '''The summary of the block from the record, None if nothing is recorded'''
+        if (self.record is None) or (self.summary_key is None):
+            return None
+        return self.record.summaries.get(self.summary_key)
         
     def update_info(self):
         pass
@@ -38,17 +50,26 @@ class InfoBlock(BoxLayout):
         return EditBlock(self.record)
 
     def edit(self):
-        edit_popup = EntryEditPopup()
-        edit_popup.add_edit_block(self.create_edit_block())
-        edit_popup.bind(on_save_finished = lambda ev: self._handle_save_finished())
-        edit_popup.open()
+        app = SymptomDiaryApp.get_running_app()
+        with app.instrumentation.action('open editor'):
+            load_rules_once(EDITOR_RULES)
+            edit_popup = EntryEditPopup()
+            edit_popup.add_edit_block(self.create_edit_block())
+            edit_popup.open()
 
 
 
 class EditBlock(BoxLayout):
+    ## The record edited, a data.DetachedCopy like InfoBlock.record
     record = None
+    ## For blocks editing a list of details, the kind of detail, a key of data.DETAIL_KINDS
+    detail_kind = None
+    ## True while the details are loaded by the DB worker
+    loading = BooleanProperty(False)
     
     def __init__(self, record, **kwargs):
+        ## The pooled labels of the detail rows
+        self.labels = []
         super(EditBlock, self).__init__(**kwargs)
         self.record = record
         self.fill_in()
@@ -56,9 +77,52 @@ class EditBlock(BoxLayout):
     def fill_in(self):
         '''Fill in the fields from the current record'''
         raise Exception("The descendant of EditBlock %s must have an fill_in function defined" % self.__class__)
+
+    def release_panels(self):
+        '''Give pooled panels back to their pools once the block is closed'''
+        for label in self.labels:
+            label_pool.release(label)
+        self.labels = []
+
+    def _add_label(self, layout, text, **properties):
+        '''Add a pooled label for a detail row to layout'''
+        label = label_pool.acquire(text)
+        for name, value in properties.items():
+            setattr(label, name, value)
+        self.labels.append(label)
+        layout.add_widget(label)
+
+    def _load_details(self, fill_in):
+        '''Load the details of detail_kind for the record on the DB worker, including virtual ones for
+           unrecorded catalog items, then call fill_in(details) with them
+        '''
+        app = SymptomDiaryApp.get_running_app()
+        self.loading = True
+        app.db.call(app.store.details_for_editing, self.record.record_id, self.detail_kind,
+                    action='load details', callback=lambda details: self._details_loaded(details, fill_in))
+
+    def _details_loaded(self, details, fill_in):
+        self.loading = False
+        ## The editor may have been closed meanwhile
+        if (self.get_root_window() is not None):
+            fill_in(details)
+
+    def _save(self, method, *args):
+        '''Save the block with method(*args) of the store, on the DB worker'''
+        app = SymptomDiaryApp.get_running_app()
+        app.save_entry_changes(self.record.date_entered, method, *args)
+
+    def _save_edited_details(self, details, edited_ids=None):
+        '''Save the details from _load_details as they were edited (see data.edited_detail_values).
+           Nothing to save before they are loaded
+        '''
+        app = SymptomDiaryApp.get_running_app()
+        mapping = edited_detail_values(self.detail_kind, details, edited_ids)
+        if mapping:
+            self._save(app.store.set_details, self.record.record_id, self.detail_kind, mapping)
         
     def update_record(self):
-        '''Update the record with fields from the block'''
+        '''Save the fields of the block to the record'''
         raise Exception("The descendant of EditBlock %s must have an update_record function defined" % self.__class__)
     
     def validate(self):
@@ -101,6 +165,10 @@ class EntryEditPopup(EditPopup):
         self.edit_block = edit_block
         self.main_content.add_widget(edit_block)
 
+    def on_dismiss(self):
+        if hasattr(self.edit_block, 'release_panels'):
+            self.edit_block.release_panels()
+
     def validate(self):
         return self.edit_block.validate()
             
@@ -120,12 +188,9 @@ class ListSummaryInfoBlock(InfoBlock):
     def on_summary_display(self):
         if (self.summary_display is not None):
             self.update_info()                                   
-
-    def summarize_record(self):
-        raise Exception("Must have a summary function for list items defined, in a derived class from ListSummaryInfoBlock")
     
     def update_info(self):
-        summary = self.summarize_record()        
+        summary = self.summary()
         if summary is not None:
             self.summary_display.text = summary
         else:
@@ -135,77 +200,163 @@ class ListSummaryInfoBlock(InfoBlock):
         raise Exception("Must have a manage popup creation function for list items defined, in a derived class from ListSummaryInfoBlock")
         
     def manage_list_items(self):
-        manage_activities_popup = self.create_list_manage_popup()
-        manage_activities_popup.open()
+        app = SymptomDiaryApp.get_running_app()
+        with app.instrumentation.action('open manage popup'):
+            load_rules_once(EDITOR_RULES)
+            manage_activities_popup = self.create_list_manage_popup()
+            manage_activities_popup.open()
 
 
 
 class ListManagePopup(Popup):
+    ## The record of the entry screen, a data.DetachedCopy
     record = None
     list_content = ObjectProperty()
     item_class = None
+    ## True while the items are loaded or saved by the DB worker
+    loading = BooleanProperty(False)
+    ## Filters of the listed items, applied in the DB
+    active_only = BooleanProperty(False)
+    name_prefix = StringProperty("")
+    ## Items fetched at a time: more than fit in the list, so that scrolling has a margin
+    page_size = 50
+    ## How close to the bottom of the list (as a fraction of its scroll range) the next page is fetched
+    fetch_margin = 0.2
 
     def __init__(self, record, **kwargs):
+        ## The position after the last listed item, None when the list is empty
+        self._last_key = None
+        self._all_fetched = False
+        ## Counts the refills, to drop pages fetched for the previous filters
+        self._generation = 0
+        self._refill_trigger = Clock.create_trigger(lambda dt: self._fill_in(), 0.25)
         super(ListManagePopup, self).__init__(**kwargs)
         self.record = record
         self._fill_in()
 
     def on_list_content(self, instance, v):
-        self.list_content.data = self.find_all_items()
+        self.list_content.bind(scroll_y=self._list_scrolled)
+        self._fill_in()
+
+    def on_active_only(self, instance, value):
+        self._fill_in()
+
+    def on_name_prefix(self, instance, value):
+        ## Wait for the typing to pause
+        self._refill_trigger()
 
     def _fill_in(self):
+        '''Empty the list and fetch its first page'''
         if (self.list_content is not None):
-            self.list_content.data = self.find_all_items()
-
-    def find_all_items(self):
-        if (self.item_class is None):
-            raise Exception("Item class not defined in ListManagePopup. "
-                            + "It must be defined as part of init, "
-                            + " before the parent constructor call")
+            if (self.item_class is None):
+                raise Exception("Item class not defined in ListManagePopup. "
+                                + "It must be defined as part of init, "
+                                + " before the parent constructor call")
+            self._generation += 1
+            self._last_key = None
+            self._all_fetched = False
+            self.list_content.data = []
+            self.loading = False
+            self.fetch_next_page()
+
+    def fetch_next_page(self):
+        if self.loading or self._all_fetched:
+            return
         app = SymptomDiaryApp.get_running_app()
-        session = app.getDBSession()
-        return session.query(self.item_class).all()
+        self.loading = True
+        generation = self._generation
+        app.db.call(app.store.catalog_page, self.item_class, self._last_key, self.page_size,
+                    self.active_only, self.name_prefix.strip(), action='load list items',
+                    callback=lambda items: self._items_loaded(generation, items))
+
+    def _items_loaded(self, generation, items):
+        if (generation != self._generation):
+            return
+        self.loading = False
+        if items:
+            self._last_key = catalog_page_key(self.item_class, items[-1])
+            self.list_content.data = self.list_content.data + items
+        self._all_fetched = (len(items) < self.page_size)
+
+    def _list_scrolled(self, list_content, scroll_y):
+        ## scroll_y goes from 1 at the top to 0 at the bottom
+        if (scroll_y <= self.fetch_margin):
+            self.fetch_next_page()
 
     def new_list_item(self):
         new_record = self.create_new_record()
         new_site_popup = self.create_edit_popup(new_record)
-        new_site_popup.bind(on_save_finished=lambda ev: self._add_new_record(new_record))
+        new_site_popup.bind(on_save_finished=lambda ev: self._save_item(new_record))
         new_site_popup.open()
 
-    def _add_new_record(self, record):
-        app = SymptomDiaryApp.get_running_app()
-        session = app.getDBSession()
-        session.add(record)
-        session.flush()
-        self._fill_in()
-
     def edit_selected_item(self):
-        popup = self.create_edit_popup(self.list_content.data[self.list_content.layout_manager.selected_nodes[0]])
+        item = self.list_content.data[self.list_content.layout_manager.selected_nodes[0]]
+        popup = self.create_edit_popup(item)
+        popup.bind(on_save_finished=lambda ev: self._save_item(item))
         popup.bind(on_dismiss=self.edit_finished)
         popup.open()
 
+    def _save_item(self, item):
+        '''Write the edited item, a data.DetachedCopy, to the session on the DB worker. The changes
+           are committed by save_edits, and dropped by cancel_edits
+        '''
+        app = SymptomDiaryApp.get_running_app()
+        self.loading = True
+        if (item.identity is None):
+            method, args = app.store.add_catalog_item, (self.item_class, item.values())
+        else:
+            method, args = app.store.update_catalog_item, (self.item_class, item.identity[0], item.values())
+        app.db.call(method, *args, action='save list item',
+                    callback=lambda duplicate_id: self._item_saved(item, duplicate_id),
+                    errback=self._save_failed)
+
+    def _item_saved(self, item, duplicate_id):
+        self.loading = False
+        if (duplicate_id is not None):
+            ErrorPopup(self.duplicate_message(item)).open()
+        ## The refill lists a new item, and undoes a rejected edit of the listed copy
+        if (item.identity is None) or (duplicate_id is not None):
+            self._fill_in()
+
     def edit_finished(self, edit_popup):
         self.list_content.refresh_from_data()
         return False
 
     def cancel_edits(self):
         app = SymptomDiaryApp.get_running_app()
-        session = app.getDBSession()
-        session.rollback()
+        app.db.call(app.store.rollback)
         self.dismiss()
 
     def save_edits(self):
         app = SymptomDiaryApp.get_running_app()
-        session = app.getDBSession()
-        session.commit()
+        self.loading = True
+        app.db.call(app.store.commit, action='save list items',
+                    callback=lambda result: self._edits_saved(),
+                    errback=self._save_failed)
+
+    def _edits_saved(self):
+        app = SymptomDiaryApp.get_running_app()
+        ## The summaries of the entries show catalog names, those of this catalog may have changed
+        app.entry_cache.clear()
+        app.reload_entry(self.record.date_entered)
+        self.loading = False
         self.dismiss()
 
+    def _save_failed(self, error):
+        ## The worker rolled back, dropping all the edits which were not saved
+        self.loading = False
+        ErrorPopup(f'Could not save the changes: {error}').open()
+        self._fill_in()
+
     def create_edit_panel(self, record):
         raise Exception("create_edit_panel must be defined in class %s, a descendant of ListManagePopup" % self.__class__)
 
     def create_new_record(self):
         raise Exception("create_new_record must be defined in class %s, a descendant of ListManagePopup" % self.__class__)
 
+    def duplicate_message(self, item):
+        raise Exception("duplicate_message must be defined in class %s, a descendant of ListManagePopup" % self.__class__)
+
     def create_edit_popup(self, record):
         popup = EntryEditPopup()
         panel = self.create_edit_panel(record)
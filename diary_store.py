@@ -0,0 +1,314 @@
+'''
+Access to a diary file without Kivy, for the GUI as well as for batch jobs and scripts:
+
+    with DiaryStore("sqlite:///diary.db") as store:
+        for record in store.get_records((date(2024, 1, 1), date(2024, 1, 31))):
+            ...
+
+A DiaryStore owns the engine of the file and one ORM session. Opening it brings the
+schema up to date and sets up the maintenance of the daily summaries and of the catalog
+cache. The session is made on first use by the thread using it; the GUI makes it on its
+DB worker thread (see db_worker.DBWorker.call) and uses the store only from there. The
+methods made for the GUI take plain values and return data.DetachedCopy objects, so that
+no object of the session reaches the GUI thread.
+
+Each method issues a bounded number of statements, whatever the size of the diary:
+the readers a fixed number (per 500 records for get_records), the batch writers a fixed
+number per chunk of rows, written with executemany. The batch writers go around the ORM,
+so they expire the loaded objects they change, and they commit, like create_entry.
+'''
+from itertools import islice
+
+from sqlalchemy import create_engine, select, inspect
+from sqlalchemy.orm import sessionmaker
+
+from data import Record, PainInfo, SleepInfo, DETAIL_KINDS, DetachedCopy, record_detail_options,\
+    find_record_by_date, load_entry_dates, load_record_with_details, details_for_editing, catalog_page,\
+    catalog_name_column, upsert_statement
+from summaries import summarize_entry
+from daily_summary import track_daily_summaries, refresh_daily_summaries
+from catalog_cache import CatalogCache, CATALOG_KEY_FIELDS
+from dbprofile import DEFAULT_PROFILE, apply_profile
+from migrations import upgrade_schema
+
+DEFAULT_CHUNK_SIZE = 500
+
+## Fields of an entry which upsert_entries writes, besides date_entered
+ENTRY_VALUE_FIELDS = ('time_entered', 'notes')
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class DiaryStore(object):
+    def __init__(self, engine_url, echo=False, sqlite_profile=DEFAULT_PROFILE, pragma_overrides=None,
+                 instrumentation=None, log=None):
+        ## The session may be made on another thread than the one opening the store
+        self.engine = create_engine(engine_url, echo=echo, connect_args={'check_same_thread': False})
+        apply_profile(self.engine, sqlite_profile, pragma_overrides)
+        if (instrumentation is not None):
+            instrumentation.attach(self.engine)
+        upgrade_schema(self.engine, log=log)
+
+        ## Objects stay loaded after a commit, so that the catalog cache, which holds the catalog
+        ## items, does not reload them one by one after every save. The store expires what its
+        ## own writes around the ORM change, and entry_snapshot reads the rows again anyway
+        self.session_factory = sessionmaker(bind=self.engine, expire_on_commit=False)
+        track_daily_summaries(self.session_factory)
+        self.catalog_cache = CatalogCache()
+        self.catalog_cache.track(self.session_factory)
+        self._session = None
+
+    def open_session(self):
+        '''Make the session of the store, on the thread which will use it. Returns it'''
+        self._session = self.session_factory()
+        return self._session
+
+    @property
+    def session(self):
+        if (self._session is None):
+            self.open_session()
+        return self._session
+
+    def close(self):
+        if (self._session is not None):
+            self._session.close()
+        self.engine.dispose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if (exc_type is not None) and (self._session is not None):
+            self._session.rollback()
+        self.close()
+
+    def commit(self):
+        self.session.commit()
+
+    def rollback(self):
+        self.session.rollback()
+
+    ## Entries
+
+    def entry_dates(self):
+        '''The dates of all the entries, in a list. One query'''
+        return load_entry_dates(self.session)
+
+    def get_record(self, date, with_details=True):
+        '''The record of the date, None if there is none. One query, or six with the details'''
+        if with_details:
+            return load_record_with_details(self.session, date)
+        return find_record_by_date(self.session, date)
+
+    def get_records(self, date_range, with_details=True):
+        '''The records of the dates in date_range, a (first, last) pair of dates, inclusive,
+           either of which may be None, ordered by date. With the details, one query for the
+           records with their pain and sleep, and one per kind of detail for each 500 records
+        '''
+        first_date, last_date = date_range
+        records = self.session.query(Record)
+        if with_details:
+            records = records.options(*record_detail_options())
+        if (first_date is not None):
+            records = records.filter(Record.date_entered >= first_date)
+        if (last_date is not None):
+            records = records.filter(Record.date_entered <= last_date)
+        return records.order_by(Record.date_entered).all()
+
+    def entry_snapshot(self, date):
+        '''What the entry screen shows of the record of the date: a DetachedCopy of the record with
+           its pain_info and sleep_info, and in its summaries attribute the summaries of its details
+           (see summaries.summarize_entry). None if there is no record. Six queries
+        '''
+        ## Read from the rows even if the record is loaded already: objects are not expired on
+        ## commit, and another program may have changed the file
+        record = self.session.query(Record).options(*record_detail_options()).populate_existing()\
+                             .filter(Record.date_entered == date).one_or_none()
+        if (record is None):
+            return None
+        entry = DetachedCopy(record, ('pain_info', 'sleep_info'))
+        entry.summaries = summarize_entry(record)
+        return entry
+
+    def create_entry(self, date, notes=None, time_entered=None):
+        '''Create and commit the record of a date, returning it'''
+        record = Record(date_entered=date, time_entered=time_entered, notes=notes)
+        self.session.add(record)
+        self.session.commit()
+        return record
+
+    def upsert_entries(self, entries, chunk_size=DEFAULT_CHUNK_SIZE):
+        '''Create or update entries, given as mappings with date_entered and any of ENTRY_VALUE_FIELDS.
+           Existing entries keep the fields which are not given. For each chunk of entries: one
+           INSERT per set of given fields, one SELECT of their record ids and the refresh of
+           their daily summaries. Commits. Returns the number of entries written
+        '''
+        table = Record.__table__
+        self.session.flush()
+        connection = self.session.connection()
+        count = 0
+        for chunk in _chunks(entries, chunk_size):
+            groups = {}
+            for entry in chunk:
+                fields = tuple(sorted(field for field in entry if (field != 'date_entered')))
+                unknown = set(fields).difference(ENTRY_VALUE_FIELDS)
+                if unknown:
+                    raise ValueError("Unknown entry fields: {}".format(", ".join(sorted(unknown))))
+                groups.setdefault(fields, []).append(dict(entry))
+            for fields, rows in groups.items():
+                if fields:
+                    statement = upsert_statement(table, ['date_entered'], fields)
+                else:
+                    statement = table.insert().prefix_with('OR IGNORE')
+                connection.execute(statement, rows)
+
+            dates = set(entry['date_entered'] for entry in chunk)
+            record_ids = [row.record_id for row in
+                          connection.execute(select(Record.record_id).where(Record.date_entered.in_(dates)))]
+            refresh_daily_summaries(connection, record_ids)
+            self._expire_loaded(Record, lambda record: record.date_entered in dates, list(ENTRY_VALUE_FIELDS))
+            count += len(chunk)
+        self.session.commit()
+        return count
+
+    def set_notes(self, record_id, notes):
+        '''Set the notes of a record. Commits'''
+        self.session.get(Record, record_id).notes = notes
+        self.session.commit()
+
+    def set_pain_info(self, record_id, values):
+        '''Set {field: value} of the PainInfo of a record, which is made if there is none. Commits'''
+        self._set_record_info(record_id, 'pain_info', PainInfo, values)
+
+    def set_sleep_info(self, record_id, values):
+        '''Set {field: value} of the SleepInfo of a record, which is made if there is none. Commits'''
+        self._set_record_info(record_id, 'sleep_info', SleepInfo, values)
+
+    def _set_record_info(self, record_id, relation, info_class, values):
+        fields = set(attribute.key for attribute in inspect(info_class).column_attrs)
+        unknown = set(values).difference(fields)
+        if unknown:
+            raise ValueError("Unknown {} fields: {}".format(info_class.__name__, ", ".join(sorted(unknown))))
+        record = self.session.get(Record, record_id)
+        info = getattr(record, relation)
+        if (info is None):
+            info = info_class(record_id)
+            setattr(record, relation, info)
+        for field, value in values.items():
+            setattr(info, field, value)
+        self.session.commit()
+
+    ## Details
+
+    def details_for_editing(self, record_id, kind):
+        '''The details of data.details_for_editing for a record, as DetachedCopies with their catalog
+           item. Two queries, the record and its details of the kind (the session does not keep the
+           records it loaded before), besides loading the catalog if it is not cached
+        '''
+        detail_kind = DETAIL_KINDS[kind]
+        record = self.session.get(Record, record_id)
+        return [DetachedCopy(detail, (detail_kind.item_relation,))
+                for detail in details_for_editing(self.session, record, kind, self.catalog_cache)]
+
+    def set_details(self, record_id, kind, mapping):
+        '''Set details of a kind (a key of DETAIL_KINDS) of a record. mapping maps catalog item ids
+           to {value field: value}, or to None to delete the detail. Details left without data
+           are deleted. Other fields and items are kept. A new detail gets the values of an
+           unrecorded one (see DetailKind.placeholder_values) for the fields not given. At most one
+           DELETE of the given items, one INSERT per set of given fields, one DELETE of the empty
+           details and the refresh of the daily summary, besides loading the catalog if it is not
+           cached. Commits
+        '''
+        detail_kind = DETAIL_KINDS[kind]
+        table = detail_kind.detail_class.__table__
+        key_columns = ['record_id', detail_kind.item_key]
+        self.session.flush()
+        connection = self.session.connection()
+
+        deleted = [item_id for item_id, values in mapping.items() if (values is None)]
+        if deleted:
+            connection.execute(table.delete().where(table.c.record_id == record_id)
+                                             .where(table.c[detail_kind.item_key].in_(deleted)))
+        groups = {}
+        for item_id, values in mapping.items():
+            if (values is None):
+                continue
+            unknown = set(values).difference(detail_kind.empty_values)
+            if unknown:
+                raise ValueError("Unknown {} fields: {}".format(kind, ", ".join(sorted(unknown))))
+            item = self.catalog_cache.item(self.session, detail_kind.item_class, item_id)
+            if (item is None):
+                raise ValueError("No {} with id {}".format(kind, item_id))
+            ## A new detail gets the values of an unrecorded one for the fields not given
+            row = detail_kind.placeholder_values(item)
+            row.update(values)
+            row.update({'record_id': record_id, detail_kind.item_key: item_id})
+            groups.setdefault(tuple(sorted(values)), []).append(row)
+        for fields, rows in groups.items():
+            if fields:
+                statement = upsert_statement(table, key_columns, fields)
+            else:
+                statement = table.insert().prefix_with('OR IGNORE')
+            connection.execute(statement, rows)
+        connection.execute(table.delete().where(table.c.record_id == record_id)
+                                         .where(detail_kind.empty_condition()))
+        refresh_daily_summaries(connection, [record_id])
+
+        self._expire_loaded(detail_kind.detail_class, lambda detail: detail.record_id == record_id)
+        self._expire_loaded(Record, lambda record: record.record_id == record_id, [detail_kind.collection])
+        self.session.commit()
+
+    ## Catalogs
+
+    def catalog(self, kind, active_only=False):
+        '''The catalog items of a kind (a key of DETAIL_KINDS), ordered by id. No query once cached'''
+        item_class = DETAIL_KINDS[kind].item_class
+        if active_only:
+            return self.catalog_cache.active_items(self.session, item_class)
+        return self.catalog_cache.items(self.session, item_class)
+
+    def catalog_page(self, item_class, after=None, limit=50, active_only=False, name_prefix=None):
+        '''The items of data.catalog_page, as DetachedCopies. One query'''
+        return [DetachedCopy(item) for item in
+                catalog_page(self.session, item_class, after, limit, active_only, name_prefix)]
+
+    def add_catalog_item(self, item_class, values):
+        '''Add an item with {field: value} to the catalog of item_class, unless another item has the
+           same key (see catalog_cache.CATALOG_KEY_FIELDS). Flushed, not committed (see commit and
+           rollback). Returns the id of the other item, None once the item is added
+        '''
+        item_id_key = inspect(item_class).primary_key[0].key
+        name_key = catalog_name_column(item_class).key
+        return self._save_catalog_item(item_class(**{item_id_key: None, name_key: values[name_key]}), values)
+
+    def update_catalog_item(self, item_class, item_id, values):
+        '''Set {field: value} of a catalog item, like add_catalog_item'''
+        return self._save_catalog_item(self.session.get(item_class, item_id), values)
+
+    def _save_catalog_item(self, item, values):
+        key_values = dict((field, values.get(field, getattr(item, field))) for field in CATALOG_KEY_FIELDS[type(item)])
+        duplicate_id = self.duplicate_id(item, **key_values)
+        if (duplicate_id is not None):
+            return duplicate_id
+        for field, value in values.items():
+            setattr(item, field, value)
+        self.session.add(item)
+        self.session.flush()
+        return None
+
+    def duplicate_id(self, item, **values):
+        '''See catalog_cache.CatalogCache.duplicate_id. At most one query'''
+        return self.catalog_cache.duplicate_id(self.session, item, **values)
+
+    def _expire_loaded(self, model, matches, attributes=None):
+        '''Expire the loaded objects of model for which matches(object) is true, after a write around the ORM'''
+        for instance in list(self.session.identity_map.values()):
+            if isinstance(instance, model) and not inspect(instance).expired and matches(instance):
+                self.session.expire(instance, attributes)
@@ -8,9 +8,21 @@ from kivy.uix.popup import Popup
 import kivy.properties as kyprops
 from kivy.uix.textinput import TextInput
 from kivy.clock import Clock
+from kivy.lang import Builder
 import datetime
 import re
 
+
+## kv files loaded by load_rules_once
+_loaded_rules = set()
+
+
+def load_rules_once(kv_file):
+    '''Load the rules of a kv file on first use. Rules apply to the widgets made after they are loaded'''
+    if (kv_file not in _loaded_rules):
+        Builder.load_file(kv_file)
+        _loaded_rules.add(kv_file)
+
 class StandardButton(Button):
     pass
 
@@ -69,6 +81,8 @@ class TabbableTextInput(TextInput):
 
 class NumericInputField(TabbableTextInput):
     value = kyprops.NumericProperty(None, allownone=True)
+    ## Whether the user typed in the field, as opposed to the value being set by the program
+    edited = kyprops.BooleanProperty(False)
     warning_color = (1, 0, 0, 1)
     # A place to save text color
     # Updated after we init from the default foreground color
@@ -83,6 +97,9 @@ class NumericInputField(TabbableTextInput):
         self.bind(value = lambda i,v: self._update_text_from_value())
         
     def _update_value(self):
+        ## The user types only in the focused field
+        if self.focus:
+            self.edited = True
         if (self.text.isspace()):
             self.value = None
         else:            
@@ -102,6 +119,14 @@ class NumericInputField(TabbableTextInput):
         else:            
             self.text = "{:n}".format(self.value)
 
+    def reset(self, value):
+        '''Show value, dropping whatever was typed before, e.g. when the field is reused'''
+        self.value = value
+        ## Setting the value it already has does not update the text
+        self._update_text_from_value()
+        self.foreground_color = self.normal_color
+        self.edited = False
+
 
 class TimeInputField(TabbableTextInput):
     value = kyprops.ObjectProperty(None, allownone=True)
@@ -270,3 +295,47 @@ class ScrollableTextDisplay(BoxLayout):
 
 class ColorLabel(Label):
     background_color = kyprops.ObjectProperty()
+
+
+class WidgetPool(object):
+    ''' A pool of widgets which are reused instead of rebuilt every time an editor is opened.
+        create(value) makes a new widget for a value, rebind(widget, value) points a recycled one
+        at a new value. Widgets are given back with release once their editor is closed.
+    '''
+    def __init__(self, create, rebind):
+        self.create = create
+        self.rebind = rebind
+        self.free_widgets = []
+
+    def acquire(self, value):
+        if self.free_widgets:
+            widget = self.free_widgets.pop()
+            self.rebind(widget, value)
+            return widget
+        return self.create(value)
+
+    def release(self, widget):
+        if widget.parent is not None:
+            widget.parent.remove_widget(widget)
+        self.free_widgets.append(widget)
+
+
+def _rebind_slider(slider, value):
+    slider.value = value
+
+
+def _rebind_numeric_input(input_field, value):
+    input_field.focus = False
+    input_field.next = None
+    input_field.reset(value)
+
+
+def _rebind_label(label, text):
+    label.text = text
+    label.size_hint_x = 1
+
+
+## Shared pools for the widgets that are created per detail row in the edit blocks
+slider_pool = WidgetPool(lambda value: SliderWithValue(value=value), _rebind_slider)
+numeric_input_pool = WidgetPool(lambda value: NumericInputField(value=value), _rebind_numeric_input)
+label_pool = WidgetPool(lambda text: Label(text=text), _rebind_label)
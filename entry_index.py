@@ -0,0 +1,77 @@
+'''
+An in-memory index of the days which have a diary entry.
+
+The index keeps one bitset (a plain python int) per year, with bit N set when
+day N of the year (counting from 0) has an entry. It is built once from the
+entries table and then kept up to date by the application as entries are
+created, so existence checks never have to go back to the DB.
+'''
+from datetime import date
+
+
+class EntryDateIndex(object):
+    '''A compact set of entry dates, with range queries over it'''
+
+    def __init__(self, dates=()):
+        self._years = {}
+        self._count = 0
+        for entry_date in dates:
+            self.add(entry_date)
+
+    @staticmethod
+    def _day_of_year(entry_date):
+        return entry_date.toordinal() - date(entry_date.year, 1, 1).toordinal()
+
+    def add(self, entry_date):
+        bit = 1 << self._day_of_year(entry_date)
+        bits = self._years.get(entry_date.year, 0)
+        if not (bits & bit):
+            self._years[entry_date.year] = bits | bit
+            self._count += 1
+
+    def discard(self, entry_date):
+        bit = 1 << self._day_of_year(entry_date)
+        bits = self._years.get(entry_date.year, 0)
+        if (bits & bit):
+            self._years[entry_date.year] = bits & ~bit
+            self._count -= 1
+
+    def __contains__(self, entry_date):
+        return bool(self._years.get(entry_date.year, 0) & (1 << self._day_of_year(entry_date)))
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for year in sorted(self._years):
+            for entry_date in self._iter_year(year, self._years[year]):
+                yield entry_date
+
+    @staticmethod
+    def _iter_year(year, bits, first_day=0):
+        year_start = date(year, 1, 1).toordinal()
+        bits >>= first_day
+        day = first_day
+        while bits:
+            if (bits & 1):
+                yield date.fromordinal(year_start + day)
+            bits >>= 1
+            day += 1
+
+    def _year_bits_in_range(self, start_date, end_date):
+        '''Yield (year, bits, first_day, last_day) for each year overlapping [start_date, end_date]'''
+        for year in range(start_date.year, end_date.year + 1):
+            first_day = self._day_of_year(start_date) if (year == start_date.year) else 0
+            if (year == end_date.year):
+                last_day = self._day_of_year(end_date)
+            else:
+                last_day = self._day_of_year(date(year, 12, 31))
+            yield year, self._years.get(year, 0), first_day, last_day
+
+    def dates_in_range(self, start_date, end_date):
+        '''Return a sorted list of dates in [start_date, end_date] which have an entry'''
+        result = []
+        for year, bits, first_day, last_day in self._year_bits_in_range(start_date, end_date):
+            bits &= (1 << (last_day + 1)) - 1
+            result.extend(self._iter_year(year, bits, first_day))
+        return result
@@ -0,0 +1,253 @@
+'''
+Export of a whole diary to CSV, without the GUI:
+
+    python export_csv.py [dbfile] [-o diary.csv] [--layout wide|long] [--start DATE] [--end DATE]
+
+The wide layout has one row per entry: its date, time and notes, pain, sleep, then one
+column per catalog item (per value field, for treatments and activities). The columns
+are laid out from the catalog tables before the first row is written.
+
+The long (tidy) layout has one row per recorded value:
+date, kind, name, unit, dosage, provider, field, value
+where unit, dosage and provider describe the catalog item, for the kinds that have them.
+
+Entries are read in chunks, ordered by date, fetching the details of a chunk with one
+query per detail table, so the memory used does not depend on the length of the diary.
+'''
+import argparse
+import csv
+import os.path
+import sys
+from datetime import date
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from data import Record, PainInfo, SleepInfo, DETAIL_KINDS
+
+DEFAULT_CHUNK_SIZE = 500
+
+ENTRY_FIELDS = ['time_entered', 'notes']
+PAIN_FIELDS = ['average_pain', 'max_pain']
+SLEEP_FIELDS = ['hours', 'minutes', 'quality', 'light_out_time', 'asleep_time', 'awake_time']
+
+LONG_HEADER = ['date', 'kind', 'name', 'unit', 'dosage', 'provider', 'field', 'value']
+
+
+def value_fields(kind):
+    '''The names of the value fields of a detail kind'''
+    return list(kind.empty_values)
+
+
+def item_description(kind_name, item):
+    '''(name, unit, dosage, provider) of a catalog item, None for what its kind does not have'''
+    if (kind_name == 'pain_site'):
+        return (item.location, None, None, None)
+    if (kind_name == 'medication'):
+        return (item.name, item.unit, item.dosage, None)
+    if (kind_name == 'treatment'):
+        return (item.name, None, None, item.provider)
+    return (item.name, None, None, None)
+
+
+def item_label(kind_name, item):
+    name, unit, dosage, provider = item_description(kind_name, item)
+    if (dosage is not None) or (unit is not None):
+        return "{} {}{}".format(name, "" if dosage is None else dosage, unit or "")
+    return name
+
+
+def format_value(value):
+    if (value is None):
+        return ""
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def load_catalogs(session):
+    '''Catalog items of every detail kind, sorted by id: {kind name: [item, ...]}'''
+    catalogs = {}
+    for kind_name, kind in DETAIL_KINDS.items():
+        catalogs[kind_name] = session.query(kind.item_class)\
+                                     .order_by(getattr(kind.item_class, kind.item_key)).all()
+    return catalogs
+
+
+def _columns(model, fields):
+    return [getattr(model, field) for field in fields]
+
+
+def iter_entry_chunks(session, start_date=None, end_date=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Yield the entries by chunks, ordered by date, as (entries, pain, sleep, details) where
+       entries is a list of rows, pain and sleep map record ids to rows, and details maps
+       detail kind names to {record id: [rows]}. Rows are plain result rows, not ORM objects.
+    '''
+    last_date = None
+    while True:
+        entry_query = session.query(Record.record_id, Record.date_entered, *_columns(Record, ENTRY_FIELDS))
+        if (last_date is not None):
+            entry_query = entry_query.filter(Record.date_entered > last_date)
+        elif (start_date is not None):
+            entry_query = entry_query.filter(Record.date_entered >= start_date)
+        if (end_date is not None):
+            entry_query = entry_query.filter(Record.date_entered <= end_date)
+        entries = entry_query.order_by(Record.date_entered).limit(chunk_size).all()
+        if not entries:
+            return
+        last_date = entries[-1].date_entered
+        record_ids = [entry.record_id for entry in entries]
+
+        pain = dict((row.record_id, row) for row in
+                    session.query(PainInfo.record_id, *_columns(PainInfo, PAIN_FIELDS))
+                           .filter(PainInfo.record_id.in_(record_ids)))
+        sleep = dict((row.record_id, row) for row in
+                     session.query(SleepInfo.record_id, *_columns(SleepInfo, SLEEP_FIELDS))
+                            .filter(SleepInfo.record_id.in_(record_ids)))
+        details = {}
+        for kind_name, kind in DETAIL_KINDS.items():
+            detail_class = kind.detail_class
+            by_record = details[kind_name] = {}
+            detail_query = session.query(detail_class.record_id, getattr(detail_class, kind.item_key),
+                                         *_columns(detail_class, value_fields(kind)))\
+                                  .filter(detail_class.record_id.in_(record_ids))
+            for row in detail_query:
+                by_record.setdefault(row.record_id, []).append(row)
+        yield entries, pain, sleep, details
+        if len(entries) < chunk_size:
+            return
+
+
+def wide_header(catalogs):
+    header = ['date'] + ENTRY_FIELDS + ['pain_' + field for field in PAIN_FIELDS]\
+             + ['sleep_' + field for field in SLEEP_FIELDS]
+    for kind_name, kind in DETAIL_KINDS.items():
+        fields = value_fields(kind)
+        for item in catalogs[kind_name]:
+            label = "{}: {}".format(kind_name, item_label(kind_name, item))
+            if len(fields) == 1:
+                header.append(label)
+            else:
+                header.extend("{} ({})".format(label, field) for field in fields)
+    return header
+
+
+def write_wide(session, output, start_date=None, end_date=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Write one row per entry. Returns the number of entries written'''
+    catalogs = load_catalogs(session)
+    writer = csv.writer(output)
+    writer.writerow(wide_header(catalogs))
+
+    ## Position of the first column of each catalog item
+    fixed_columns = 1 + len(ENTRY_FIELDS) + len(PAIN_FIELDS) + len(SLEEP_FIELDS)
+    item_columns = {}
+    column = fixed_columns
+    for kind_name, kind in DETAIL_KINDS.items():
+        width = len(value_fields(kind))
+        item_columns[kind_name] = {}
+        for item in catalogs[kind_name]:
+            item_columns[kind_name][getattr(item, kind.item_key)] = column
+            column += width
+    row_width = column
+
+    count = 0
+    for entries, pain, sleep, details in iter_entry_chunks(session, start_date, end_date, chunk_size):
+        for entry in entries:
+            row = [""] * row_width
+            row[0] = format_value(entry.date_entered)
+            values = [getattr(entry, field) for field in ENTRY_FIELDS]
+            pain_row = pain.get(entry.record_id)
+            values += [getattr(pain_row, field) if pain_row else None for field in PAIN_FIELDS]
+            sleep_row = sleep.get(entry.record_id)
+            values += [getattr(sleep_row, field) if sleep_row else None for field in SLEEP_FIELDS]
+            row[1:fixed_columns] = [format_value(value) for value in values]
+            for kind_name, kind in DETAIL_KINDS.items():
+                fields = value_fields(kind)
+                for detail in details[kind_name].get(entry.record_id, ()):
+                    column = item_columns[kind_name][getattr(detail, kind.item_key)]
+                    row[column:column + len(fields)] = [format_value(getattr(detail, field)) for field in fields]
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_long(session, output, start_date=None, end_date=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Write one row per recorded value. Returns the number of entries written'''
+    catalogs = load_catalogs(session)
+    descriptions = dict((kind_name, dict((getattr(item, DETAIL_KINDS[kind_name].item_key),
+                                          [format_value(value) for value in item_description(kind_name, item)])
+                                         for item in items))
+                        for kind_name, items in catalogs.items())
+    writer = csv.writer(output)
+    writer.writerow(LONG_HEADER)
+
+    count = 0
+    for entries, pain, sleep, details in iter_entry_chunks(session, start_date, end_date, chunk_size):
+        for entry in entries:
+            entry_date = format_value(entry.date_entered)
+            for kind_name, fields, row in [('entry', ENTRY_FIELDS, entry),
+                                           ('pain', PAIN_FIELDS, pain.get(entry.record_id)),
+                                           ('sleep', SLEEP_FIELDS, sleep.get(entry.record_id))]:
+                if (row is None):
+                    continue
+                for field in fields:
+                    value = getattr(row, field)
+                    if (value is not None):
+                        writer.writerow([entry_date, kind_name, "", "", "", "", field, format_value(value)])
+            for kind_name, kind in DETAIL_KINDS.items():
+                for detail in details[kind_name].get(entry.record_id, ()):
+                    description = descriptions[kind_name][getattr(detail, kind.item_key)]
+                    for field in value_fields(kind):
+                        value = getattr(detail, field)
+                        if (value is not None):
+                            writer.writerow([entry_date, kind_name] + description + [field, format_value(value)])
+            count += 1
+    return count
+
+
+LAYOUTS = {
+    'wide': write_wide,
+    'long': write_long,
+}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Export a symptom diary to CSV")
+    parser.add_argument('dbfile', nargs='?', default=None,
+                        help="Diary DB file. Defaults to data/entries.db in the script directory")
+    parser.add_argument('-o', '--output', default=None, help="CSV file to write, standard output by default")
+    parser.add_argument('--layout', choices=sorted(LAYOUTS), default='wide',
+                        help="One row per entry (wide, the default) or one row per value (long)")
+    parser.add_argument('--start', type=date.fromisoformat, default=None, metavar='YYYY-MM-DD',
+                        help="First date to export")
+    parser.add_argument('--end', type=date.fromisoformat, default=None, metavar='YYYY-MM-DD',
+                        help="Last date to export")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Number of entries read at a time (default %(default)s)")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.dbfile is not None:
+        db_file = os.path.realpath(args.dbfile)
+    else:
+        db_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data", "entries.db")
+    if not os.path.exists(db_file):
+        print("No diary file {}".format(db_file), file=sys.stderr)
+        sys.exit(1)
+    engine = create_engine(f"sqlite:///{db_file}")
+    session = sessionmaker(bind=engine)()
+    output = sys.stdout if (args.output is None) else open(args.output, 'w', newline='')
+    try:
+        count = LAYOUTS[args.layout](session, output, args.start, args.end, args.chunk_size)
+    finally:
+        if (output is not sys.stdout):
+            output.close()
+        session.close()
+        engine.dispose()
+    print("{} entries exported".format(count), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,309 @@
+'''
+Import of diary data from CSV files in the long layout written by export_csv.py,
+without the GUI:
+
+    python import_csv.py diary.csv [dbfile] [--dry-run] [--chunk-size DAYS]
+
+Each row is one value: date, kind, name, unit, dosage, provider, field, value, where kind
+is entry, pain, sleep or a detail kind (pain_site, symptom, medication, treatment,
+activity). Catalog items are matched by name (by name, unit and dosage for medications,
+by location for pain sites), ignoring case like the catalog edit panels, and created when
+missing. Values for a date which already has an entry are merged into it: imported values
+replace the stored ones, values that are not in the file are kept.
+
+The file is read twice: first to validate every row, then to write, one transaction per
+chunk of dates, with one executemany upsert per table. --dry-run stops after validating.
+'''
+import argparse
+import csv
+import os.path
+import sys
+from collections import namedtuple
+from datetime import date, time
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+import catalog_cache
+from data import Record, PainInfo, SleepInfo, DETAIL_KINDS, upsert_statement
+from daily_summary import refresh_daily_summaries
+from export_csv import ENTRY_FIELDS, PAIN_FIELDS, SLEEP_FIELDS, LONG_HEADER, value_fields
+from migrations import upgrade_schema
+
+DEFAULT_CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 20
+
+## A validated row of the file
+ImportedValue = namedtuple('ImportedValue', ['date', 'kind', 'item_key', 'item_values', 'field', 'value'])
+
+
+class CSVImportError(ValueError):
+    def __init__(self, line, message):
+        super(CSVImportError, self).__init__("line {}: {}".format(line, message))
+        self.line = line
+
+
+def _parse_int(text):
+    return int(text)
+
+
+def _parse_time(text):
+    return time.fromisoformat(text)
+
+
+## Models of the per-entry kinds, and the parsers of their fields
+ENTRY_KINDS = {
+    'entry': (Record, dict([('time_entered', _parse_time), ('notes', str)])),
+    'pain': (PainInfo, dict((field, _parse_int) for field in PAIN_FIELDS)),
+    'sleep': (SleepInfo, dict((field, _parse_time if field.endswith('_time') else _parse_int)
+                              for field in SLEEP_FIELDS)),
+}
+
+
+def catalog_key(kind_name, values):
+    '''The key of a catalog item with the given {field: value}, compared ignoring case like
+       the catalog cache does (see catalog_cache.item_key)
+    '''
+    return catalog_cache.item_key(DETAIL_KINDS[kind_name].item_class, values)
+
+
+def catalog_values(kind_name, name, unit, dosage, provider):
+    '''Column values of a new catalog item'''
+    if (kind_name == 'pain_site'):
+        return {'location': name, 'active': True}
+    if (kind_name == 'medication'):
+        ## quantity is the usual number of doses, which the file does not have
+        return {'name': name, 'unit': unit, 'dosage': dosage, 'quantity': 1, 'active': True}
+    if (kind_name == 'treatment'):
+        return {'name': name, 'provider': provider, 'active': True}
+    return {'name': name, 'active': True}
+
+
+def parse_row(line, row):
+    '''Validate one row of the file and return it as an ImportedValue'''
+    if len(row) != len(LONG_HEADER):
+        raise CSVImportError(line, "expected {} columns, got {}".format(len(LONG_HEADER), len(row)))
+    date_text, kind_name, name, unit, dosage, provider, field, text = row
+    try:
+        entry_date = date.fromisoformat(date_text)
+    except ValueError:
+        raise CSVImportError(line, "invalid date {!r}".format(date_text))
+
+    if (kind_name in ENTRY_KINDS):
+        parsers = ENTRY_KINDS[kind_name][1]
+        item_key = item_values = None
+    elif (kind_name in DETAIL_KINDS):
+        parsers = dict((value_field, _parse_int) for value_field in value_fields(DETAIL_KINDS[kind_name]))
+        if not name.strip():
+            raise CSVImportError(line, "{} without a name".format(kind_name))
+        if (kind_name == 'medication') and not unit.strip():
+            raise CSVImportError(line, "medication {} without a unit".format(name))
+        try:
+            dosage = int(dosage) if dosage.strip() else None
+        except ValueError:
+            raise CSVImportError(line, "invalid dosage {!r}".format(dosage))
+        item_values = catalog_values(kind_name, name, unit, dosage, provider or None)
+        item_key = catalog_key(kind_name, item_values)
+    else:
+        raise CSVImportError(line, "unknown kind {!r}".format(kind_name))
+
+    parser = parsers.get(field)
+    if (parser is None):
+        raise CSVImportError(line, "unknown field {!r} for {}, expected one of {}".format(
+                                        field, kind_name, ", ".join(parsers)))
+    try:
+        value = parser(text)
+    except ValueError:
+        raise CSVImportError(line, "invalid value {!r} for {} {}".format(text, kind_name, field))
+    return ImportedValue(entry_date, kind_name, item_key, item_values, field, value)
+
+
+def read_values(csv_file, errors):
+    '''Yield the valid rows of the file as ImportedValues, appending CSVImportErrors for the others to errors'''
+    reader = csv.reader(csv_file)
+    header = next(reader, None)
+    if (header != LONG_HEADER):
+        errors.append(CSVImportError(1, "the header must be {}".format(",".join(LONG_HEADER))))
+        return
+    for row in reader:
+        if not row:
+            continue
+        try:
+            yield parse_row(reader.line_num, row)
+        except CSVImportError as error:
+            errors.append(error)
+
+
+def _column(model, attribute):
+    '''The table column mapped to a model attribute, e.g. PainInfo.average_pain is "averagepain"'''
+    return getattr(model, attribute).property.columns[0]
+
+
+class DiaryImporter(object):
+    '''Writes ImportedValues into a diary, creating the missing catalog items'''
+
+    def __init__(self, connection, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.connection = connection
+        self.chunk_size = chunk_size
+        self.counts = {'entries': 0, 'values': 0}
+        ## kind name -> {catalog key: item id}
+        self.item_ids = {}
+        session = sessionmaker(bind=connection)()
+        for kind_name, kind in DETAIL_KINDS.items():
+            self.item_ids[kind_name] = {}
+            key_fields = catalog_cache.CATALOG_KEY_FIELDS[kind.item_class]
+            ## By id, so that the first of items differing only in case keeps the key, like in the cache
+            for item in session.query(kind.item_class).order_by(getattr(kind.item_class, kind.item_key)):
+                values = dict((field, getattr(item, field)) for field in key_fields)
+                self.item_ids[kind_name].setdefault(catalog_key(kind_name, values), getattr(item, kind.item_key))
+        session.close()
+
+    def _item_id(self, value):
+        '''Id of the catalog item of the value, inserting the item if it is new'''
+        known = self.item_ids[value.kind]
+        item_id = known.get(value.item_key)
+        if (item_id is None):
+            table = DETAIL_KINDS[value.kind].item_class.__table__
+            item_id = self.connection.execute(table.insert(), value.item_values).inserted_primary_key[0]
+            known[value.item_key] = item_id
+            self.counts['new ' + value.kind] = self.counts.get('new ' + value.kind, 0) + 1
+        return item_id
+
+    def import_values(self, values):
+        '''Import an iterable of ImportedValues, one transaction per chunk of dates'''
+        chunk = {}
+        for value in values:
+            if (value.date not in chunk) and (len(chunk) >= self.chunk_size):
+                self._write_chunk(chunk)
+                chunk = {}
+            chunk.setdefault(value.date, []).append(value)
+        if chunk:
+            self._write_chunk(chunk)
+        return self.counts
+
+    def _write_chunk(self, chunk):
+        with self.connection.begin():
+            self._write_entries(chunk)
+            record_ids = dict(self.connection.execute(
+                    select(Record.date_entered, Record.record_id)
+                    .where(Record.date_entered.in_(list(chunk)))).fetchall())
+
+            ## table -> {key tuple: row}, merging the values of a row given on several lines
+            rows = {}
+            for entry_date, values in chunk.items():
+                record_id = record_ids[entry_date]
+                for value in values:
+                    if (value.kind == 'entry'):
+                        continue
+                    if (value.kind in ENTRY_KINDS):
+                        model = ENTRY_KINDS[value.kind][0]
+                        key = (record_id,)
+                        row = rows.setdefault(model, {}).setdefault(key, {'record_id': record_id})
+                    else:
+                        kind = DETAIL_KINDS[value.kind]
+                        model = kind.detail_class
+                        item_id = self._item_id(value)
+                        row = rows.setdefault(model, {}).setdefault((record_id, item_id),
+                                                                    {'record_id': record_id, kind.item_key: item_id})
+                    row[_column(model, value.field).name] = value.value
+                    self.counts['values'] += 1
+
+            for model, model_rows in rows.items():
+                self._write_rows(model, list(model_rows.values()))
+            refresh_daily_summaries(self.connection, record_ids.values())
+
+    def _write_entries(self, chunk):
+        columns = [_column(Record, field).name for field in ENTRY_FIELDS]
+        entry_rows = []
+        for entry_date, values in chunk.items():
+            row = dict((column, None) for column in columns)
+            row['date_entered'] = entry_date
+            for value in values:
+                if (value.kind == 'entry'):
+                    row[_column(Record, value.field).name] = value.value
+                    self.counts['values'] += 1
+            entry_rows.append(row)
+        ## date_entered is unique: the entries of existing dates are updated in place
+        self.connection.execute(upsert_statement(Record.__table__, ['date_entered'], columns, keep_existing=True),
+                                entry_rows)
+        self.counts['entries'] += len(entry_rows)
+
+    def _write_rows(self, model, rows):
+        table = model.__table__
+        key_columns = [column.name for column in table.primary_key]
+        ## Rows giving values for different columns need different statements,
+        ## an existing row must only be updated with the values of the file
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(sorted(column for column in row if column not in key_columns)), []).append(row)
+        for given_columns, group in groups.items():
+            for column in table.columns:
+                if (column.name in key_columns) or (column.name in given_columns):
+                    continue
+                ## For new rows the NOT NULL columns get the defaults the models use
+                if column.nullable:
+                    default = None
+                else:
+                    default = column.default.arg if (column.default is not None) else 0
+                for row in group:
+                    row[column.name] = default
+            self.connection.execute(upsert_statement(table, key_columns, given_columns, keep_existing=True), group)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Import diary data from a CSV file in the long layout of export_csv.py")
+    parser.add_argument('csvfile', help="CSV file to import")
+    parser.add_argument('dbfile', nargs='?', default=None,
+                        help="Diary DB file. Defaults to data/entries.db in the script directory")
+    parser.add_argument('--dry-run', action='store_true', help="Only validate the file, write nothing")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Number of days written per transaction (default %(default)s)")
+    return parser.parse_args(argv)
+
+
+def validate_file(csv_path):
+    '''Read the whole file, returning (number of valid values, dates, errors)'''
+    errors = []
+    count = 0
+    dates = set()
+    with open(csv_path, newline='') as csv_file:
+        for value in read_values(csv_file, errors):
+            count += 1
+            dates.add(value.date)
+    return count, dates, errors
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.dbfile is not None:
+        db_file = os.path.realpath(args.dbfile)
+    else:
+        db_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data", "entries.db")
+
+    count, dates, errors = validate_file(args.csvfile)
+    for error in errors[:MAX_REPORTED_ERRORS]:
+        print(error, file=sys.stderr)
+    if len(errors) > MAX_REPORTED_ERRORS:
+        print("... and {} more errors".format(len(errors) - MAX_REPORTED_ERRORS), file=sys.stderr)
+    if errors:
+        print("Nothing imported, fix the errors first", file=sys.stderr)
+        sys.exit(1)
+    if args.dry_run:
+        print("{} values for {} days are valid, nothing written (dry run)".format(count, len(dates)))
+        return
+
+    engine = create_engine(f"sqlite:///{db_file}")
+    try:
+        upgrade_schema(engine, log=print)
+        with engine.connect() as connection:
+            importer = DiaryImporter(connection, args.chunk_size)
+            with open(args.csvfile, newline='') as csv_file:
+                counts = importer.import_values(read_values(csv_file, []))
+    finally:
+        engine.dispose()
+    for name, value in sorted(counts.items()):
+        print("{}: {}".format(name, value))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,150 @@
+'''
+Opt-in query counting and latency measurement, built on SQLAlchemy engine events.
+
+Statements are attributed to the innermost active user action (e.g. "open entry"),
+or to "(no action)" if they run outside of any. Each thread has its own stack of active
+actions, so the statements of the DB worker thread are not attributed to whatever the
+main thread is doing meanwhile. When instrumentation is disabled the application uses
+NullInstrumentation, which registers no engine events and whose action() returns a
+shared do-nothing context, so it costs nothing.
+'''
+import json
+import sys
+import threading
+import time
+
+from sqlalchemy import event
+
+NO_ACTION = "(no action)"
+
+
+class ActionStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall_time = 0.0
+        self.queries = 0
+        self.query_time = 0.0
+        self.max_query_time = 0.0
+
+    def add_query(self, elapsed):
+        self.queries += 1
+        self.query_time += elapsed
+        if elapsed > self.max_query_time:
+            self.max_query_time = elapsed
+
+    def as_dict(self):
+        return {'action': self.name,
+                'calls': self.calls,
+                'wall_time_ms': self.wall_time * 1000,
+                'queries': self.queries,
+                'query_time_ms': self.query_time * 1000,
+                'max_query_time_ms': self.max_query_time * 1000,
+                'queries_per_call': (self.queries / self.calls) if self.calls else None}
+
+
+class _ActionContext(object):
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.instrumentation._action_stack.append(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        self.instrumentation._action_stack.pop()
+        stats = self.instrumentation._stats_for(self.name)
+        stats.calls += 1
+        stats.wall_time += elapsed
+        return False
+
+
+class QueryInstrumentation(object):
+    '''Counts queries and statement latency per user action'''
+    enabled = True
+
+    def __init__(self, json_path=None, print_summary=True):
+        self.json_path = json_path
+        self.print_summary = print_summary
+        self.stats = {}
+        self._local = threading.local()
+
+    @property
+    def _action_stack(self):
+        stack = getattr(self._local, 'action_stack', None)
+        if (stack is None):
+            stack = self._local.action_stack = []
+        return stack
+
+    def attach(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def action(self, name):
+        '''A context manager attributing everything that runs within it to the named action'''
+        return _ActionContext(self, name)
+
+    def _stats_for(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = ActionStats(name)
+        return stats
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+        if self._action_stack:
+            name = self._action_stack[-1]
+        else:
+            name = NO_ACTION
+        self._stats_for(name).add_query(elapsed)
+
+    def summary_table(self):
+        lines = ["{:<22} {:>6} {:>11} {:>8} {:>11} {:>11}".format(
+                    "action", "calls", "wall ms", "queries", "query ms", "max q ms")]
+        for stats in sorted(self.stats.values(), key=lambda st: -st.wall_time - st.query_time):
+            lines.append("{:<22} {:>6d} {:>11.2f} {:>8d} {:>11.2f} {:>11.3f}".format(
+                    stats.name, stats.calls, stats.wall_time * 1000, stats.queries,
+                    stats.query_time * 1000, stats.max_query_time * 1000))
+        return "\n".join(lines)
+
+    def as_dict(self):
+        return {'actions': [stats.as_dict() for stats in self.stats.values()]}
+
+    def report(self):
+        '''Print the summary table and/or write the JSON file, as configured'''
+        if self.print_summary:
+            print(self.summary_table(), file=sys.stderr)
+        if self.json_path is not None:
+            with open(self.json_path, 'w') as json_file:
+                json.dump(self.as_dict(), json_file, indent=2)
+
+
+class _NullActionContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_ACTION = _NullActionContext()
+
+
+class NullInstrumentation(object):
+    '''Used when instrumentation is off: no engine events, no bookkeeping'''
+    enabled = False
+
+    def attach(self, engine):
+        pass
+
+    def action(self, name):
+        return _NULL_ACTION
+
+    def report(self):
+        pass
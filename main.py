@@ -1,30 +1,61 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+## Made first, to time the imports too
+from startup_timer import StartupTimer
+STARTUP_TIMER = StartupTimer()
 
 from kivy.app import App
-from kivy.uix.boxlayout import BoxLayout
-from kivy.uix.recycleview import RecycleView
 
-from kivy.properties import ObjectProperty, StringProperty, ListProperty
+from kivy.properties import ObjectProperty, ListProperty
 from kivy.uix.screenmanager import ScreenManager, Screen,\
     ShaderTransition
-from kivy.uix.recycleboxlayout import RecycleBoxLayout
 
-import datetime
-from data import Record, Base
-from sqlalchemy.orm.exc import NoResultFound
+from diary_store import DiaryStore
+from entry_index import EntryDateIndex
+from cache import LRUCache
 
 from kivy.config import Config
+from kivy.clock import Clock
 from kivy.lang import Builder
 import sys
-from diary_widgets import ErrorPopup
+from diary_widgets import ErrorPopup, load_rules_once
 import os.path
+import argparse
+from instrumentation import QueryInstrumentation, NullInstrumentation
+from db_worker import DBWorker
+from dbprofile import PROFILES, DEFAULT_PROFILE, parse_pragma_override
+from calendar import monthrange
 
+## Number of recently displayed entries kept, as the snapshots the entry screen shows
+ENTRY_CACHE_SIZE = 32
 
-Config.set('widgets', 'scroll_timeout', 250)
-Config.set('widgets', 'scroll_distance', 5)
-Config.write()
+## (section, option, value) of the Kivy configuration this application needs
+KIVY_SETTINGS = [
+    ('widgets', 'scroll_timeout', 250),
+    ('widgets', 'scroll_distance', 5),
+]
 
+## The rules of the entry screen, and of the editors opened from it, are loaded on first use
+ENTRY_DISPLAY_RULES = 'kv/entrydisplay.kv'
+
+
+def configure_kivy():
+    '''Apply KIVY_SETTINGS, writing the Kivy config file only if they changed something'''
+    changed = False
+    for section, option, value in KIVY_SETTINGS:
+        if (not Config.has_option(section, option)) or (Config.get(section, option) != str(value)):
+            Config.set(section, option, value)
+            changed = True
+    if changed:
+        Config.write()
+
+
+configure_kivy()
+STARTUP_TIMER.mark('imports')
+
+
+
+def run_on_main_thread(callback):
+    '''Call callback() from the Kivy main loop, at the start of the next frame'''
+    Clock.schedule_once(lambda dt: callback())
 
 
 class MyCustomScreen(Screen):
@@ -46,13 +77,22 @@ class EntryScreen(MyCustomScreen):
     notes_content = ObjectProperty()
     date = ObjectProperty()
     info_blocks = ListProperty()
+    ## The date of the entry being loaded, None once it is shown
+    loading_date = None
     
     def fill_in(self, record):
+        self.loading_date = None
         self.date.text = record.date_entered.isoformat()
         
         for info_block in self.info_blocks:
             info_block.fill_in(record)
 
+    def show_loading(self, date):
+        self.loading_date = date
+        self.date.text = date.isoformat()
+        for info_block in self.info_blocks:
+            info_block.loading = True
+
 
 
 class CalendarScreen(MyCustomScreen):
@@ -61,78 +101,124 @@ class CalendarScreen(MyCustomScreen):
  
 class SymptomDiaryApp(App):
     engine_path = None
-    engine = None
+    ## The diary_store.DiaryStore of the diary file, all the data access goes through it
+    store = None
     
     calendar_screen = None
     entry_screen = None
     screen_manager = None
-
-#### This is a global for session management
-#### We assume that all processing will be called from the main GUI thread
-#### And use a thread-local manager
+    entry_index = None
+    instrumentation = None
+    ## Recently displayed entries by date, as made by DiaryStore.entry_snapshot
+    entry_cache = None
+    ## A startup_timer.StartupTimer reporting the startup phases, or None
+    startup_timer = None
+
+#### The session of the store belongs to the DB worker thread, and the calls to the store
+#### are submitted to it (see db_worker.py), so that slow storage does not block the GUI.
+#### The GUI only gets plain values and data.DetachedCopy objects back from them.
 #### We site it in symptom diary app because we can always get a running app
-#### Everyone should call getDBSession to get this session
-    __Session = None
+    db = None
 
 
  
-    def __init__(self, engine_path, **kwargs):
+    def __init__(self, engine_path, echo=False, instrumentation=None,
+                 sqlite_profile=DEFAULT_PROFILE, pragma_overrides=None, startup_timer=None, **kwargs):
         self.engine_path = engine_path
+        self.startup_timer = startup_timer
         super(SymptomDiaryApp, self).__init__(**kwargs)
-        self.engine = create_engine(self.engine_path, echo=True)
-        Base.metadata.create_all(self.engine)
-
-
-        session_factory = sessionmaker(bind=self.engine)
-        self.__Session = scoped_session(session_factory)
+        if (instrumentation is None):
+            instrumentation = NullInstrumentation()
+        self.instrumentation = instrumentation
+        self.store = DiaryStore(self.engine_path, echo=echo, sqlite_profile=sqlite_profile,
+                                pragma_overrides=pragma_overrides, instrumentation=self.instrumentation,
+                                log=lambda message: print(message, file=sys.stderr))
+        self._mark_startup('open and check the DB')
+
+        ## The session of the store is made on the worker thread
+        self.db = DBWorker(self.store.open_session, dispatch=run_on_main_thread, instrumentation=self.instrumentation)
+
+        # Built once here, then kept up to date by create_entry_by_date
+        self.entry_index = EntryDateIndex(self._load_entry_dates())
+        self.entry_cache = LRUCache(ENTRY_CACHE_SIZE)
+        self._mark_startup('load the entry dates')
         
         
         
         
     def build(self):
         Builder.load_file('kv/diarywidgets.kv')        
-        Builder.load_file('kv/entryedit.kv')        
-        Builder.load_file('kv/entrydisplay.kv')
         Builder.load_file('kv/appscreens.kv')
-        # initalise the screen manager, add screens and game widget to game screen then return it
+        self._mark_startup('load the calendar rules')
+        # initalise the screen manager with the calendar screen only, the entry screen is made on first use
         self.screen_manager = ScreenManager(transition = ShaderTransition(duration=0.01))
         self.calendar_screen = CalendarScreen(name='calendar')
-        self.entry_screen = EntryScreen(name='entry')
         self.screen_manager.add_widget(self.calendar_screen)
-        self.screen_manager.add_widget(self.entry_screen)
+        self._mark_startup('build the calendar')
  
         return self.screen_manager
 
+    def on_start(self):
+        if (self.startup_timer is not None):
+            from kivy.core.window import Window
+            Window.bind(on_flip=self._first_frame_shown)
+
+    def _first_frame_shown(self, window):
+        window.unbind(on_flip=self._first_frame_shown)
+        self._mark_startup('first frame')
+        self.startup_timer.report()
+
+    def _mark_startup(self, phase):
+        if (self.startup_timer is not None):
+            self.startup_timer.mark(phase)
+
+    def get_entry_screen(self):
+        '''The entry screen, made on first use, after loading its rules and the modules of its blocks'''
+        if (self.entry_screen is None):
+            with self.instrumentation.action('load entry screen'):
+                load_rules_once(ENTRY_DISPLAY_RULES)
+                self.entry_screen = EntryScreen(name='entry')
+                self.screen_manager.add_widget(self.entry_screen)
+        return self.entry_screen
+
+    def on_stop(self):
+        self.db.shutdown()
+        self.store.close()
+        self.instrumentation.report()
 
     def show_calendar_screen(self):
         self.screen_manager.current = 'calendar'
         
-    def getDBSession(self):
-        ### This will be a locally managed session
-        ### Because we are using scoped_session
-        return self.__Session()
-
-
-    def find_entry_by_date(self, date):
-        session = self.getDBSession()
-        entryQuery = session.query(Record).filter(Record.date_entered == date)
-        try:
-            result = entryQuery.one()
-        except NoResultFound:
-            result = None
-        
-        return result
+    def find_entry_by_date(self, date, callback):
+        '''Load the entry of the date on the DB worker, then call callback(entry or None) with
+           the entry as made by DiaryStore.entry_snapshot
+        '''
+        self.db.call(self.store.entry_snapshot, date, callback=callback)
+
+    def has_entry(self, date):
+        return date in self.entry_index
+
+    def find_entry_dates_in_range(self, start_date, end_date):
+        '''Return the set of dates in [start_date, end_date] which have an entry, from the in-memory index'''
+        return set(self.entry_index.dates_in_range(start_date, end_date))
+
+    def find_entry_dates_in_month(self, month_start):
+        '''Return the set of dates in the month starting at month_start which have an entry'''
+        numdays = monthrange(month_start.year, month_start.month)[1]
+        return self.find_entry_dates_in_range(month_start.replace(day=1),
+                                              month_start.replace(day=numdays))
         
     def create_entry_by_date(self, date, time, notes):
         # first check if entry does not exist
         print('mooo')
 
-        if (self.find_entry_by_date(date) is None):
+        if (not self.has_entry(date)):
             print("Will create entry for ", date)
-            new_entry = Record(date_entered = date, notes = notes)
-            session = self.getDBSession()
-            session.add(new_entry)
-            session.commit()
+            ## Added to the index right away, so that the entry can be displayed while it is created:
+            ## the worker runs the load after the creation
+            self.entry_index.add(date)
+            self.db.call(self.store.create_entry, date, notes, action='create entry',
+                         errback=lambda error: self._create_entry_failed(date, error))
         else:
             popup = ErrorPopup(
                 f'Cannot create entry for the date of {date.isoformat()} because one already exists. You can edit it instead'
@@ -141,43 +227,114 @@ class SymptomDiaryApp(App):
 
 
         
+    def _create_entry_failed(self, date, error):
+        self.entry_index.discard(date)
+        ErrorPopup(f'Could not create the entry for {date.isoformat()}: {error}').open()
+
     def display_entry_by_date(self, date):
         print("Will display entry for: ", date)
 
-        entryScreen = self.screen_manager.get_screen('entry')
+        with self.instrumentation.action('open entry'):
+            self._display_entry_by_date(date)
 
-        entry = self.find_entry_by_date(date)        
+    def _display_entry_by_date(self, date):
+        if not self.has_entry(date):
+            self._show_missing_entry(date)
+            return
 
+        ## A recently displayed entry is shown right away, others are loaded by the DB worker
+        entry = self.entry_cache.get(date)
         if (entry is not None):
-            entryScreen.fill_in(entry)
-            self.screen_manager.current = 'entry'
+            self.get_entry_screen().fill_in(entry)
         else:
-            popup = ErrorPopup(f'No entry for the date of {date.isoformat()}')
+            self._load_entry(date)
+        self.screen_manager.current = 'entry'
+
+    def _load_entry(self, date):
+        self.get_entry_screen().show_loading(date)
+        self.db.call(self.store.entry_snapshot, date, action='load entry',
+                     callback=lambda entry: self._entry_loaded(date, entry))
+
+    def reload_entry(self, date):
+        '''Load the entry of the date again after it changed, and show it'''
+        self.entry_cache.discard(date)
+        self._load_entry(date)
+
+    def save_entry_changes(self, date, method, *args):
+        '''Save changes of the entry of the date with method(*args) of the store, on the DB worker,
+           then show the entry as it was saved
+        '''
+        self.db.call(method, *args, action='save block',
+                     errback=lambda error: ErrorPopup(f'Could not save the changes: {error}').open())
+        ## Loaded after the save, which the worker runs first
+        self.reload_entry(date)
+
+    def _entry_loaded(self, date, entry):
+        if (entry is None):
+            self.show_calendar_screen()
+            self._show_missing_entry(date)
+            return
+        self.entry_cache.put(date, entry)
+        entryScreen = self.get_entry_screen()
+        ## The user may have gone on to another date meanwhile
+        if (entryScreen.loading_date == date):
+            entryScreen.fill_in(entry)
 
-            popup.open()
-        
-        
-    def getEntryDates(self):
-        session = self.__Session()
-        return [result.date for result in session.query(Record.date_entered.label('date'))]
+    def _show_missing_entry(self, date):
+        popup = ErrorPopup(f'No entry for the date of {date.isoformat()}')
+        popup.open()
 
+    def getEntryDates(self):
+        return list(self.entry_index)
+
+    def _load_entry_dates(self):
+        return self.db.call_and_wait(self.store.entry_dates)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Symptom diary")
+    parser.add_argument('dbfile', nargs='?', default=None,
+                        help="Diary DB file. Defaults to data/entries.db in the script directory")
+    parser.add_argument('--echo', action='store_true',
+                        help="Print every SQL statement as it is executed")
+    parser.add_argument('--profile-queries', action='store_true',
+                        help="Count queries and time them per user action, print a summary on exit")
+    parser.add_argument('--profile-output', metavar='JSON_FILE', default=None,
+                        help="Write the per-action query profile to this JSON file on exit")
+    parser.add_argument('--sqlite-profile', choices=sorted(PROFILES), default=DEFAULT_PROFILE,
+                        help="SQLite performance profile (default %(default)s). 'fast' uses WAL with synchronous=NORMAL")
+    parser.add_argument('--pragma', action='append', default=[], metavar='NAME=VALUE',
+                        help="Override a single SQLite pragma of the profile, e.g. --pragma cache_size=-64000")
+    parser.add_argument('--startup-report', action='store_true',
+                        help="Print how long each phase of the startup took, up to the first frame")
+    return parser.parse_args(argv)
 
-def usage():
-    print(sys.stderr, "Error in command line arguments. Usage: %s [dbfile]".format(sys.argv[0]))
-    sys.exit(1)
     
 def main(argv):
-    if len(argv) > 1:
-        usage()
+    args = parse_args(argv)
 
-    if len(argv) == 1:
-        db_file = os.path.realpath(argv[0])
+    if args.dbfile is not None:
+        db_file = os.path.realpath(args.dbfile)
     else:
         script_dir = os.path.dirname(os.path.realpath(__file__))
         db_file = f"{script_dir}/data/entries.db"
+
+    if args.profile_queries or (args.profile_output is not None):
+        instrumentation = QueryInstrumentation(json_path=args.profile_output,
+                                               print_summary=args.profile_queries)
+    else:
+        instrumentation = None
+        
+    try:
+        pragma_overrides = dict(parse_pragma_override(text) for text in args.pragma)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
         
     engine_path = f"sqlite:///{db_file}"
-    SymptomDiaryApp(engine_path).run()
+    SymptomDiaryApp(engine_path, echo=args.echo, instrumentation=instrumentation,
+                    sqlite_profile=args.sqlite_profile, pragma_overrides=pragma_overrides,
+                    startup_timer=STARTUP_TIMER if args.startup_report else None).run()
 
     
     
@@ -0,0 +1,104 @@
+'''
+Maintenance commands for diary files, run without the GUI:
+
+    python maintenance.py compact [dbfile]
+    python maintenance.py migrate [dbfile]
+    python maintenance.py summarize [dbfile]
+    python maintenance.py schema > schema.db
+'''
+import argparse
+import os.path
+import sys
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from data import delete_empty_details
+from migrations import upgrade_schema, schema_sql
+from daily_summary import rebuild_daily_summaries
+
+
+def default_db_file():
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    return f"{script_dir}/data/entries.db"
+
+
+def compact(session, args):
+    '''Delete the detail rows holding no data, e.g. placeholders written just by opening an editor'''
+    deleted = delete_empty_details(session)
+    if args.dry_run:
+        session.rollback()
+    else:
+        session.commit()
+    for kind_name, count in sorted(deleted.items()):
+        print("{}: {} empty detail row(s) {}".format(kind_name, count,
+                                                     "would be deleted" if args.dry_run else "deleted"))
+    if args.vacuum and not args.dry_run:
+        session.connection().exec_driver_sql("VACUUM")
+
+
+def migrate(session, args):
+    '''Upgrade the schema of the diary file to the latest version'''
+    ## upgrade_schema runs its own transaction
+    session.close()
+    old_version, new_version = upgrade_schema(session.get_bind(), log=print, full_check=True)
+    if old_version == new_version:
+        print("Schema is up to date, version {}".format(new_version))
+    else:
+        print("Schema upgraded from version {} to {}".format(old_version, new_version))
+
+
+def summarize(session, args):
+    '''Rebuild the daily_summary table from all the records'''
+    ## Older files may not have the table yet
+    session.close()
+    upgrade_schema(session.get_bind(), log=print)
+    count = rebuild_daily_summaries(session.connection())
+    session.commit()
+    print("{} daily summary row(s) rebuilt".format(count))
+
+
+def schema(session, args):
+    '''Print the DDL of the current schema, as kept in schema.db'''
+    sys.stdout.write(schema_sql(session.get_bind()))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Symptom diary maintenance")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    compact_parser = subparsers.add_parser('compact', help=compact.__doc__)
+    compact_parser.add_argument('--dry-run', action='store_true', help="Only count the rows to delete")
+    compact_parser.add_argument('--vacuum', action='store_true', help="Reclaim the freed space afterwards")
+    compact_parser.set_defaults(run=compact)
+
+    migrate_parser = subparsers.add_parser('migrate', help=migrate.__doc__)
+    migrate_parser.set_defaults(run=migrate)
+
+    summarize_parser = subparsers.add_parser('summarize', help=summarize.__doc__)
+    summarize_parser.set_defaults(run=summarize)
+
+    schema_parser = subparsers.add_parser('schema', help=schema.__doc__)
+    schema_parser.set_defaults(run=schema)
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('dbfile', nargs='?', default=None,
+                               help="Diary DB file. Defaults to data/entries.db in the script directory")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    db_file = os.path.realpath(args.dbfile) if (args.dbfile is not None) else default_db_file()
+    engine = create_engine(f"sqlite:///{db_file}")
+    session = sessionmaker(bind=engine)()
+    try:
+        args.run(session, args)
+    finally:
+        session.close()
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
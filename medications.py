@@ -5,13 +5,11 @@ Created on 20 Nov 2013
 '''
 from diary_content import ListManagePopup, EditBlock, ListSummaryInfoBlock, ListManagerEditBlock
 from main import SymptomDiaryApp
-from diary_widgets import ErrorPopup, NumericInputField
-from sqlalchemy.orm.exc import NoResultFound
+from diary_widgets import ErrorPopup, numeric_input_pool
 from kivy.properties import ObjectProperty, StringProperty, BooleanProperty
 import operator
 import sys
-from kivy.uix.label import Label
-from data import Medication, MedicationInfo
+from data import Medication, DetachedCopy
 from kivy.uix.gridlayout import GridLayout
 
 class MedicationListManagePopup(ListManagePopup): 
@@ -27,7 +25,11 @@ class MedicationListManagePopup(ListManagePopup):
         return MedicationEditPanel(record)
 
     def create_new_record(self):
-        return Medication("")
+        return DetachedCopy(Medication(None, ""))
+
+    def duplicate_message(self, item):
+        return ("Medication %s with dosage %s %s is already defined in the DB. You must edit that record instead"
+                % (item.name, item.dosage, item.unit))
 
 
 class MedicationEditPanel(GridLayout):
@@ -65,26 +67,6 @@ class MedicationEditPanel(GridLayout):
             error_popup = ErrorPopup(text="Quantity must be a number")
             error_popup.open()
             return False
-
-
-        app = SymptomDiaryApp.get_running_app()  
-        session = app.getDBSession()
-        
-        medication_query = session.query(Medication).filter(Medication.name == name)\
-                                .filter(Medication.unit == unit) \
-                                .filter(Medication.dosage == dosage)
-        try:
-            result = medication_query.one()
-        except NoResultFound:
-            result = None
-            
-        if (result is not None) and (result.medication_id != self.record.medication_id):
-            # We found a similar record (same medication and dosage ) but it has a different ID
-            # We should not allow such duplicates            
-            error_popup = ErrorPopup(text = "Medication %s with dosage %s %s is already defined in the DB. You must edit that record instead" 
-                                                % (name, dosage, unit) )
-            error_popup.open()
-            return False
         
         return True
 
@@ -104,46 +86,34 @@ class MedicationEditPanel(GridLayout):
         
 
 class MedicationInfoBlock(ListSummaryInfoBlock):
+    summary_key = 'medication'
  
     def create_edit_block(self):
         return MedicationDetailEditBlock(self.record)
 
     def create_list_manage_popup(self):
         return MedicationListManagePopup(self.record, title="Manage Medications");
-
-    def summarize_record(self):
-        summary = None
-        if (self.record is not None) and (self.record.medication_info is not None):
-            for si in self.record.medication_info:
-                if (si.quantity is not None):
-                    short_descr = "{} {:g}{}: {:d} time(s)".format(si.medication.name, 
-                                                                   si.medication.dosage,
-                                                                   si.medication.unit,
-                                                                   si.quantity)
-                else:
-                    short_descr = "{}: not taken".format(si.medication.name)
-                    
-                if summary is None:
-                    summary = short_descr
-                else:
-                    summary += ", " + short_descr
-        return summary
                    
 
 class MedicationDetailEditBlock(EditBlock):
     medications_block = ObjectProperty()
-    inputs = []
+    detail_kind = 'medication'
+
+    def __init__(self, record, **kwargs):
+        self.inputs = []
+        super(MedicationDetailEditBlock, self).__init__(record, **kwargs)
 
     def fill_in(self):
-        '''Fill in the fields from the current record'''
-        self._create_medication_info()
+        '''Fill in the fields from the current record, once its details are loaded'''
+        self._load_details(self._fill_in_details)
+
+    def _fill_in_details(self, details):
         prev_mi = None
                 
-        for mi in self.record.medication_info:
-            self.medications_block.add_widget(
-                    Label(text = "{} {:g}{}".format(mi.medication.name, mi.medication.dosage, mi.medication.unit))
-                )
-            mi_field = NumericInputField(value=mi.quantity);
+        for mi in details:
+            self._add_label(self.medications_block,
+                            "{} {:g}{}".format(mi.medication.name, mi.medication.dosage, mi.medication.unit))
+            mi_field = numeric_input_pool.acquire(mi.quantity)
             if (prev_mi is not None):
                 prev_mi.next = mi_field
             prev_mi = mi_field
@@ -154,25 +124,18 @@ class MedicationDetailEditBlock(EditBlock):
             self.inputs[0][0].focus = True
 
     def update_record(self):
-        '''Update the record with fields from the block'''
+        '''Save the fields of the block to the record'''
+        ## The usual quantity shown for an unrecorded medication is only saved if the user enters it
+        edited_ids = set()
         for (ni_field,mi) in self.inputs:
             mi.quantity = ni_field.value
+            if ni_field.edited:
+                edited_ids.add(mi.medication_id)
+        self._save_edited_details([mi for (ni_field, mi) in self.inputs], edited_ids)
+
+    def release_panels(self):
+        for (ni_field, mi) in self.inputs:
+            numeric_input_pool.release(ni_field)
+        self.inputs = []
+        super(MedicationDetailEditBlock, self).release_panels()
         
-    def _create_medication_info(self):
-        if self.record.medication_info is not None:
-            known_medication_ids = set(map(operator.attrgetter('medication_id'), self.record.medication_info))
-        else:
-            known_medication_ids = set()
-        app = SymptomDiaryApp.get_running_app()  
-        session = app.getDBSession()
-        all_medications_found = session.query(Medication).filter(Medication.active == True).all()
-        not_known_medications = filter(lambda med: med.medication_id not in known_medication_ids, all_medications_found )
-        
-        for medication in not_known_medications:
-            mi = MedicationInfo(record_id=self.record.record_id, 
-                                medication_id=medication.medication_id, 
-                                quantity=medication.quantity)
-            session.add(mi)
-        session.flush()
-        session.refresh(self.record)
-    
@@ -0,0 +1,174 @@
+'''
+Versioned schema migrations for diary files.
+
+The schema version of a file is kept in "PRAGMA user_version". upgrade_schema creates
+any missing tables from the models in data.py, then runs, in order, each migration newer
+than the file's version, in one transaction. Files created from scratch get the
+indexes from the models, so on them the migrations find nothing to do.
+
+The transaction covers the DDL too: pysqlite commits on its own before CREATE and other
+DDL statements, so the upgrade turns that off on its connection and issues BEGIN itself
+(see atomic_connection). If a step fails, the file is left as it was, version included.
+
+After that, upgrade_schema stores the fingerprint of the schema (a hash of the DDL of
+the models and of the latest migration version) in the schema_meta table. When a file
+already has the fingerprint of the running program, its schema is taken as up to date
+and upgrade_schema returns after that single lookup, without reflecting the tables. The
+fingerprint is computed once per process, so opening more files does not compile the DDL again.
+"python maintenance.py migrate" always does the full check.
+'''
+import hashlib
+from contextlib import contextmanager
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+from data import Base, SchemaMeta, DETAIL_KINDS, catalog_name_column
+from daily_summary import rebuild_daily_summaries
+
+
+class Migration(object):
+    def __init__(self, version, description, upgrade):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    '''Register the decorated function(connection) as the migration to the given version'''
+    def register(upgrade):
+        if MIGRATIONS and (MIGRATIONS[-1].version >= version):
+            raise ValueError("Migrations must be registered in increasing version order, got %d" % version)
+        MIGRATIONS.append(Migration(version, description, upgrade))
+        return upgrade
+    return register
+
+
+def _indexed_columns(connection, table_name):
+    '''The list of column tuples covered, as a prefix, by indexes of the table'''
+    indexed = []
+    for index_row in connection.exec_driver_sql("PRAGMA index_list(%s)" % table_name):
+        index_name = index_row[1]
+        columns = [info_row[2] for info_row in connection.exec_driver_sql("PRAGMA index_info(%s)" % index_name)]
+        indexed.append(tuple(columns))
+    return indexed
+
+
+@migration(1, "Add (item, record) indexes to the detail tables")
+def _add_detail_item_indexes(connection):
+    for kind in DETAIL_KINDS.values():
+        table_name = kind.detail_class.__tablename__
+        connection.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_%s_%s_record ON %s (%s, record_id)"
+                                   % (table_name, kind.item_key, table_name, kind.item_key))
+
+
+@migration(2, "Index entries by date")
+def _add_entry_date_index(connection):
+    ## The unique constraint on date_entered normally comes with an index already,
+    ## only older files made without it need one
+    if not any(columns[:1] == ('date_entered',) for columns in _indexed_columns(connection, 'entries')):
+        connection.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_entries_date_entered ON entries (date_entered)")
+
+
+@migration(3, "Fill in the daily_summary table")
+def _fill_daily_summary(connection):
+    ## The table itself was just made by create_all
+    rebuild_daily_summaries(connection)
+
+
+@migration(4, "Index the catalog names case-insensitively")
+def _add_catalog_lower_name_indexes(connection):
+    for kind in DETAIL_KINDS.values():
+        table_name = kind.item_class.__tablename__
+        column_name = catalog_name_column(kind.item_class).name
+        connection.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_%s_lower_%s ON %s (lower(%s))"
+                                   % (table_name, column_name, table_name, column_name))
+
+
+def latest_version():
+    return MIGRATIONS[-1].version if MIGRATIONS else 0
+
+
+def schema_version(connection):
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+## dialect name -> fingerprint; the models and migrations do not change while the program runs
+_fingerprints = {}
+
+
+def schema_fingerprint(engine):
+    '''A hash of the schema defined by the models and the migrations, computed once per dialect'''
+    fingerprint = _fingerprints.get(engine.dialect.name)
+    if (fingerprint is None):
+        text = "version %d\n%s" % (latest_version(), schema_sql(engine))
+        fingerprint = _fingerprints[engine.dialect.name] = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    return fingerprint
+
+
+def stored_fingerprint(connection):
+    '''The schema fingerprint stored in the file, None if there is none'''
+    try:
+        return connection.exec_driver_sql("SELECT value FROM %s WHERE name = 'fingerprint'"
+                                          % SchemaMeta.__tablename__).scalar()
+    except OperationalError:
+        ## Files from before the schema_meta table
+        return None
+
+
+@contextmanager
+def atomic_connection(engine):
+    '''A connection of engine in a transaction which also covers DDL statements, committed at the
+       end of the block, or rolled back if it raises
+    '''
+    with engine.connect() as connection:
+        dbapi_connection = connection.connection.dbapi_connection
+        driver_isolation_level = dbapi_connection.isolation_level
+        ## With None, pysqlite neither begins transactions nor commits before DDL
+        dbapi_connection.isolation_level = None
+        try:
+            with connection.begin():
+                connection.exec_driver_sql("BEGIN")
+                yield connection
+        finally:
+            dbapi_connection.isolation_level = driver_isolation_level
+
+
+def upgrade_schema(engine, log=None, full_check=False):
+    '''Bring the schema of the DB up to date. Returns the (old, new) schema versions.
+       Unless full_check is true, a file with the fingerprint of the current schema is not checked further
+    '''
+    fingerprint = schema_fingerprint(engine)
+    if not full_check:
+        with engine.connect() as connection:
+            if (stored_fingerprint(connection) == fingerprint):
+                return latest_version(), latest_version()
+
+    with atomic_connection(engine) as connection:
+        old_version = schema_version(connection)
+        if old_version > latest_version():
+            raise RuntimeError("The diary file has schema version %d, newer than this program supports (%d)"
+                               % (old_version, latest_version()))
+        Base.metadata.create_all(connection)
+        for pending in MIGRATIONS:
+            if pending.version > old_version:
+                if log is not None:
+                    log("Migrating schema to version %d: %s" % (pending.version, pending.description))
+                pending.upgrade(connection)
+                connection.exec_driver_sql("PRAGMA user_version = %d" % pending.version)
+        connection.execute(SchemaMeta.__table__.insert().prefix_with('OR REPLACE'),
+                           {'name': 'fingerprint', 'value': fingerprint})
+        return old_version, schema_version(connection)
+
+
+def schema_sql(engine):
+    '''The DDL of the schema defined by the models, as SQLite statements'''
+    statements = []
+    for table in Base.metadata.sorted_tables:
+        statements.append(str(CreateTable(table).compile(engine)).strip() + ";")
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            statements.append(str(CreateIndex(index).compile(engine)).strip() + ";")
+    return "\n\n".join(statements) + "\n"
@@ -5,6 +5,7 @@ Created on 18 Dec 2013
 '''
 
 from diary_content import EditBlock, InfoBlock
+from main import SymptomDiaryApp
 from kivy.properties import StringProperty
 
 
@@ -34,6 +35,7 @@ class NotesEditBlock(EditBlock):
             self.notes_input.value = self.record.notes
 
     def update_record(self):
-        '''Update the record with fields from the block'''
-        self.record.notes = self.notes_input.value
+        '''Save the fields of the block to the record'''
+        app = SymptomDiaryApp.get_running_app()
+        self._save(app.store.set_notes, self.record.record_id, self.notes_input.value)
         
\ No newline at end of file
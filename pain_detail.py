@@ -5,14 +5,11 @@ Created on 20 Nov 2013
 '''
 from diary_content import ListManagePopup, EditBlock, ListSummaryInfoBlock, ListManagerEditBlock
 from main import SymptomDiaryApp
-from data import PainSite, PainSiteInfo
-from diary_widgets import ErrorPopup, SliderWithValue
-from sqlalchemy.sql.expression import func
-from sqlalchemy.orm.exc import NoResultFound
+from data import PainSite, DetachedCopy
+from diary_widgets import ErrorPopup, slider_pool
 from kivy.properties import ObjectProperty, StringProperty, BooleanProperty
 import operator
 import sys
-from kivy.uix.label import Label
 from kivy.uix.gridlayout import GridLayout
 
 class PainSiteListManagePopup(ListManagePopup): 
@@ -28,7 +25,10 @@ class PainSiteListManagePopup(ListManagePopup):
         return PainSiteEditPanel(record)
     
     def create_new_record(self):
-        return PainSite(None, location = "")
+        return DetachedCopy(PainSite(None, location = ""))
+
+    def duplicate_message(self, item):
+        return "Pain site %s is already defined in the DB. You must edit that record instead" % (item.location)
 
 
 
@@ -50,24 +50,6 @@ class PainSiteEditPanel(GridLayout):
             error_popup = ErrorPopup(text="Name must be non-empty and contain only alphanumeric characters. Entered: %s" % location)
             error_popup.open()
             return False
-                
-        app = SymptomDiaryApp.get_running_app()  
-        session = app.getDBSession()
-        
-        pain_site_query = session.query(PainSite).filter(func.lower(PainSite.location) == location)
-
-        try:
-            result = pain_site_query.one()
-        except NoResultFound:
-            result = None
-            
-        if (result is not None) and (result.pain_site_id != self.record.pain_site_id):
-            # We found a similar record (same name ) but it has a different ID
-            # We should not allow such duplicates            
-            error_popup = ErrorPopup(text = "Pain site %s is already defined in the DB. You must edit that record instead" 
-                                                % (location) )
-            error_popup.open()
-            return False
         
         return True
 
@@ -80,6 +62,7 @@ class PainSiteEditPanel(GridLayout):
 
 
 class PainDetailInfoBlock(ListSummaryInfoBlock):
+    summary_key = 'pain_site'
  
     def create_edit_block(self):
         return PainDetailEditBlock(self.record)
@@ -87,49 +70,35 @@ class PainDetailInfoBlock(ListSummaryInfoBlock):
     def create_list_manage_popup(self):
         return PainSiteListManagePopup(self.record, title="Manage Medications");
 
-    def summarize_record(self):
-        summary = None
-        if (self.record is not None) and (self.record.pain_site_info is not None):
-            for psi in self.record.pain_site_info:
-                short_descr = "%s: %s" % (psi.site.location, psi.painlevel)
-                if summary is None:
-                    summary = short_descr
-                else:
-                    summary += ", " + short_descr        
-        return summary
-
 
 class PainDetailEditBlock(EditBlock):
     pain_sites_block = ObjectProperty()
-    sliders = []
+    detail_kind = 'pain_site'
+
+    def __init__(self, record, **kwargs):
+        self.sliders = []
+        super(PainDetailEditBlock, self).__init__(record, **kwargs)
 
     def fill_in(self):
-        '''Fill in the fields from the current record'''
-        self._create_symptom_info()
-                
-        for pi in self.record.pain_site_info:
-            self.pain_sites_block.add_widget(Label(text=pi.site.location))
-            slider = SliderWithValue(value=pi.painlevel)
+        '''Fill in the fields from the current record, once its details are loaded'''
+        self._load_details(self._fill_in_details)
+
+    def _fill_in_details(self, details):
+        for pi in details:
+            self._add_label(self.pain_sites_block, pi.site.location)
+            slider = slider_pool.acquire(pi.painlevel)
             self.sliders.append((slider, pi))
             self.pain_sites_block.add_widget(slider)
 
+    def release_panels(self):
+        for (slider, pi) in self.sliders:
+            slider_pool.release(slider)
+        self.sliders = []
+        super(PainDetailEditBlock, self).release_panels()
+
     def update_record(self):
-        '''Update the record with fields from the block'''
+        '''Save the fields of the block to the record'''
         for (slider,pi) in self.sliders:
             pi.painlevel = slider.value
+        self._save_edited_details([pi for (slider, pi) in self.sliders])
         
-    def _create_symptom_info(self):
-        if self.record.pain_site_info is not None:
-            known_sites = set(map(operator.attrgetter('site_id'), self.record.pain_site_info))
-        else:
-            known_sites = set()
-        app = SymptomDiaryApp.get_running_app()  
-        session = app.getDBSession()
-        all_sites_found = session.query(PainSite).filter(PainSite.active == True).all()
-        found_ids = set(map(operator.attrgetter('site_id'), all_sites_found))
-        for site_id in (found_ids - known_sites):
-            psi = PainSiteInfo(record_id=self.record.record_id, site_id=site_id)
-            session.add(psi)
-        session.flush()
-        session.refresh(self.record)
-    
@@ -3,9 +3,8 @@ Created on 18 Dec 2013
 
 @author: myrosia
 '''
-from data import PainInfo
-from main import SymptomDiaryApp
 from diary_content import InfoBlock, EditBlock
+from main import SymptomDiaryApp
 
 from kivy.properties import StringProperty, NumericProperty
 
@@ -41,14 +40,7 @@ class PainEditBlock(EditBlock):
             self.max_pain = self.record.pain_info.max_pain
 
     def update_record(self):
-        '''Update the record with fields from the block'''
-        if (self.record.pain_info is None):
-            ### we need t create a new pain info
-            app = SymptomDiaryApp.get_running_app()  
-            session = app.getDBSession()
-            pinfo = PainInfo(record_id=self.record.record_id)
-            session.add(pinfo)
-            self.record.pain_info = pinfo
-
-        self.record.pain_info.average_pain = self.average_pain
-        self.record.pain_info.max_pain = self.max_pain
+        '''Save the fields of the block to the record'''
+        app = SymptomDiaryApp.get_running_app()
+        self._save(app.store.set_pain_info, self.record.record_id,
+                   {'average_pain': self.average_pain, 'max_pain': self.max_pain})
@@ -8,10 +8,10 @@ from main import SymptomDiaryApp
 from diary_widgets import ErrorPopup
 from kivy.properties import ObjectProperty, StringProperty, BooleanProperty, NumericProperty
 import sys
-from data import SleepInfo
 
 class SleepInfoBlock(InfoBlock):
     sleep_summary = StringProperty()
+    summary_key = 'sleep'
  
     def __init__(self, **kwargs):
         self.update_info()                                   
@@ -20,29 +20,10 @@ class SleepInfoBlock(InfoBlock):
     def create_edit_block(self):
         return SleepEditBlock(self.record)
 
-    def format_time_value(self, time_val):
-        if (time_val is None):
-            return "unspecified"
-        else:
-            return time_val.strftime("%H:%M")
-    
     def update_info(self):
-        if (self.record is not None) and (self.record.sleep_info is not None):
-            short_descr = "{!s} hours {!s} minutes".format(self.record.sleep_info.hours, self.record.sleep_info.minutes)
-            if ((self.record.sleep_info.light_out_time is not None)
-                 or (self.record.sleep_info.asleep_time is not None)
-                 or (self.record.sleep_info.awake_time is not None)):
-                short_descr += " (Lights out: {!s}; Asleep: {!s}; Awake: {!s})".format(
-                                    self.format_time_value(self.record.sleep_info.light_out_time), 
-                                    self.format_time_value(self.record.sleep_info.asleep_time), 
-                                    self.format_time_value(self.record.sleep_info.awake_time)
-                                )
-
-            if (self.record.sleep_info.quality is not None):
-                short_descr += ", quality: {!s}".format(self.record.sleep_info.quality)
-            else:
-                short_descr += ", quality not recorded"
-            self.sleep_summary = short_descr
+        summary = self.summary()
+        if (summary is not None):
+            self.sleep_summary = summary
         else:
             self.sleep_summary = "Not recorded"
                    
@@ -73,22 +54,15 @@ class SleepEditBlock(EditBlock):
             
 
     def update_record(self):
-        '''Update the record with fields from the block'''
+        '''Save the fields of the block to the record'''
         
         print(sys.stderr, "Updating record in sleep edit block")
         
-        if (self.record.sleep_info is None):
-            ### we need t create a new pain info
-            app = SymptomDiaryApp.get_running_app()  
-            session = app.getDBSession()
-            sinfo = SleepInfo(record_id=self.record.record_id)
-            session.add(sinfo)
-            self.record.sleep_info = sinfo
-            
-
-        self.record.sleep_info.hours = self.hours_input_field.value
-        self.record.sleep_info.minutes = self.minutes_input_field.value
-        self.record.sleep_info.quality = self.quality_slider.value
-        self.record.sleep_info.light_out_time = self.lights_out_input_field.value
-        self.record.sleep_info.asleep_time = self.asleep_input_field.value
-        self.record.sleep_info.awake_time = self.awake_input_field.value
+        app = SymptomDiaryApp.get_running_app()
+        self._save(app.store.set_sleep_info, self.record.record_id,
+                   {'hours': self.hours_input_field.value,
+                    'minutes': self.minutes_input_field.value,
+                    'quality': self.quality_slider.value,
+                    'light_out_time': self.lights_out_input_field.value,
+                    'asleep_time': self.asleep_input_field.value,
+                    'awake_time': self.awake_input_field.value})
@@ -0,0 +1,58 @@
+'''
+Timing of the startup of the application, from the start of the process to the first
+frame on screen, by phase:
+
+    python main.py --startup-report
+
+Phases end at the marks set along the startup (StartupTimer.mark), each lasting from the
+previous mark. The time the interpreter took before the timer was made is read from
+/proc on Linux, and left out elsewhere.
+'''
+import os
+import sys
+import time
+
+
+def process_age():
+    '''Seconds since the start of the process, None where /proc does not tell'''
+    try:
+        with open('/proc/self/stat') as stat_file:
+            ## The command name may contain spaces, the fields after it do not
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        ## starttime is the 22nd field, the fields list starts at the 3rd
+        return uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupTimer(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        ## Time spent before the timer was made (interpreter start, first imports), if known
+        self.before_start = process_age()
+        ## (phase name, end time)
+        self.marks = []
+
+    def mark(self, phase):
+        '''End the current phase, naming it'''
+        self.marks.append((phase, time.perf_counter()))
+
+    def phases(self):
+        '''[(phase name, seconds)], from the start of the process if it is known'''
+        phases = []
+        if (self.before_start is not None):
+            phases.append(('python start', self.before_start))
+        previous = self.start
+        for phase, end in self.marks:
+            phases.append((phase, end - previous))
+            previous = end
+        return phases
+
+    def report(self, file=sys.stderr):
+        total = 0.0
+        print("Startup time by phase:", file=file)
+        for phase, seconds in self.phases():
+            total += seconds
+            print("  {:<24} {:8.1f} ms  (at {:8.1f} ms)".format(phase, seconds * 1000, total * 1000), file=file)
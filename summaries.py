@@ -0,0 +1,127 @@
+'''
+Text summaries of the details of a record, as shown in the entry display InfoBlocks.
+
+These only depend on the data model, so they can be used (and benchmarked) without Kivy.
+The application computes them on the DB worker when it loads an entry (see
+diary_store.DiaryStore.entry_snapshot) and keeps them with the entry.
+'''
+
+
+def _join_summary(descriptions):
+    '''Join short descriptions into a summary, None if there were none'''
+    if descriptions:
+        return ", ".join(descriptions)
+    return None
+
+
+def summarize_pain_sites(record):
+    if (record is None) or (record.pain_site_info is None):
+        return None
+    return _join_summary(["%s: %s" % (psi.site.location, psi.painlevel)
+                          for psi in record.pain_site_info])
+
+
+def summarize_symptoms(record):
+    if (record is None) or (record.symptom_info is None):
+        return None
+    return _join_summary(["%s: %s" % (si.symptom.name, si.intensity)
+                          for si in record.symptom_info])
+
+
+def describe_medication_detail(mi):
+    if (mi.quantity is not None):
+        return "{} {:g}{}: {:d} time(s)".format(mi.medication.name,
+                                                mi.medication.dosage,
+                                                mi.medication.unit,
+                                                mi.quantity)
+    return "{}: not taken".format(mi.medication.name)
+
+
+def summarize_medications(record):
+    if (record is None) or (record.medication_info is None):
+        return None
+    return _join_summary([describe_medication_detail(mi) for mi in record.medication_info])
+
+
+def describe_treatment_detail(ti):
+    if (ti.times_per_day) or (ti.hours) or (ti.minutes):
+        short_descr = "{}".format(ti.treatment.name)
+        if (ti.treatment.provider is not None):
+            short_descr += " from {}".format(ti.treatment.provider)
+        if (ti.times_per_day):
+            short_descr += " %d times" % (ti.times_per_day)
+        if (ti.hours) or (ti.minutes):
+            short_descr += " for "
+            if (ti.hours):
+                short_descr += " %d hours" % ti.hours
+            if (ti.minutes):
+                short_descr += " %d minutes" % ti.minutes
+        return short_descr
+    return "%s: not taken" % (ti.treatment.name)
+
+
+def summarize_treatments(record):
+    if (record is None) or (record.treatment_info is None):
+        return None
+    return _join_summary([describe_treatment_detail(ti) for ti in record.treatment_info])
+
+
+def describe_activity_detail(ai):
+    if (ai.hours) or (ai.minutes):
+        short_descr = "{} for {:d} hour(s) {:d} minute(s)".format(ai.activity.name, ai.hours, ai.minutes)
+        if (ai.intensity):
+            short_descr += ", intensity: {:n}".format(ai.intensity)
+        return short_descr
+    return "{}: not taken".format(ai.activity.name)
+
+
+def summarize_activities(record):
+    if (record is None) or (record.activity_info is None):
+        return None
+    return _join_summary([describe_activity_detail(ai) for ai in record.activity_info])
+
+
+def format_time_value(time_val):
+    if (time_val is None):
+        return "unspecified"
+    else:
+        return time_val.strftime("%H:%M")
+
+
+def summarize_sleep(record):
+    if (record is None) or (record.sleep_info is None):
+        return None
+    sleep_info = record.sleep_info
+    short_descr = "{!s} hours {!s} minutes".format(sleep_info.hours, sleep_info.minutes)
+    if ((sleep_info.light_out_time is not None)
+         or (sleep_info.asleep_time is not None)
+         or (sleep_info.awake_time is not None)):
+        short_descr += " (Lights out: {!s}; Asleep: {!s}; Awake: {!s})".format(
+                            format_time_value(sleep_info.light_out_time),
+                            format_time_value(sleep_info.asleep_time),
+                            format_time_value(sleep_info.awake_time)
+                        )
+
+    if (sleep_info.quality is not None):
+        short_descr += ", quality: {!s}".format(sleep_info.quality)
+    else:
+        short_descr += ", quality not recorded"
+    return short_descr
+
+
+## Summaries of the detail lists, by detail kind (see data.DETAIL_KINDS)
+DETAIL_SUMMARIES = {
+    'pain_site': summarize_pain_sites,
+    'symptom': summarize_symptoms,
+    'medication': summarize_medications,
+    'treatment': summarize_treatments,
+    'activity': summarize_activities,
+}
+
+
+def summarize_entry(record):
+    '''The summaries of the record by block key: the detail kinds and 'sleep'. None for nothing recorded'''
+    summaries = dict((kind_name, summarize(record)) for kind_name, summarize in DETAIL_SUMMARIES.items())
+    summaries['sleep'] = summarize_sleep(record)
+    return summaries
+
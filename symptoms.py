@@ -6,14 +6,11 @@ Created on 20 Nov 2013
 from diary_content import ListManagePopup, EditBlock, ListSummaryInfoBlock,\
     ListManagerEditBlock
 from main import SymptomDiaryApp
-from diary_widgets import ErrorPopup, SliderWithValue
-from sqlalchemy.sql.expression import func
-from sqlalchemy.orm.exc import NoResultFound
+from diary_widgets import ErrorPopup, slider_pool
 from kivy.properties import ObjectProperty, StringProperty, BooleanProperty
 import operator
 import sys
-from kivy.uix.label import Label
-from data import Symptom, SymptomInfo
+from data import Symptom, DetachedCopy
 from kivy.uix.gridlayout import GridLayout
 
 
@@ -31,7 +28,10 @@ class SymptomListManagePopup(ListManagePopup):
         return SymptomEditPanel(record)
 
     def create_new_record(self):
-        return Symptom(None, name = "")
+        return DetachedCopy(Symptom(None, name = ""))
+
+    def duplicate_message(self, item):
+        return "Symptom %s is already defined in the DB. You must edit that record instead" % (item.name)
 
 
 
@@ -53,24 +53,6 @@ class SymptomEditPanel(GridLayout):
             error_popup = ErrorPopup(text="Symptom name must be non-empty and contain only alphanumeric characters. Entered: %s" % name)
             error_popup.open()
             return False
-                
-        app = SymptomDiaryApp.get_running_app()  
-        session = app.getDBSession()
-        
-        symptom_query = session.query(Symptom).filter(func.lower(Symptom.name) == name)
-
-        try:
-            result = symptom_query.one()
-        except NoResultFound:
-            result = None
-            
-        if (result is not None) and (result.symptom_id != self.record.symptom_id):
-            # We found a similar record (same name ) but it has a different ID
-            # We should not allow such duplicates            
-            error_popup = ErrorPopup(text = "Symptom %s is already defined in the DB. You must edit that record instead" 
-                                                % (name) )
-            error_popup.open()
-            return False
         
         return True
 
@@ -84,6 +66,7 @@ class SymptomEditPanel(GridLayout):
 
 
 class SymptomInfoBlock(ListSummaryInfoBlock):
+    summary_key = 'symptom'
          
     def create_edit_block(self):
         return SymptomDetailEditBlock(self.record)
@@ -91,49 +74,36 @@ class SymptomInfoBlock(ListSummaryInfoBlock):
     def create_list_manage_popup(self):
         return SymptomListManagePopup(self.record, title="Manage Symptoms");
 
-    def summarize_record(self):
-        summary = None
-        if (self.record is not None) and (self.record.symptom_info is not None):
-            for si in self.record.symptom_info:
-                short_descr = "%s: %s" % (si.symptom.name, si.intensity)
-                if summary is None:
-                    summary = short_descr
-                else:
-                    summary += ", " + short_descr
-        return summary
-
 
 
 class SymptomDetailEditBlock(EditBlock):
     symptoms_block = ObjectProperty()
-    sliders = []
+    detail_kind = 'symptom'
+
+    def __init__(self, record, **kwargs):
+        self.sliders = []
+        super(SymptomDetailEditBlock, self).__init__(record, **kwargs)
 
     def fill_in(self):
-        '''Fill in the fields from the current record'''
-        self._create_symptom_info()
-                
-        for si in self.record.symptom_info:
-            self.symptoms_block.add_widget(Label(text=si.symptom.name))
-            slider = SliderWithValue(value=si.intensity)
+        '''Fill in the fields from the current record, once its details are loaded'''
+        self._load_details(self._fill_in_details)
+
+    def _fill_in_details(self, details):
+        for si in details:
+            self._add_label(self.symptoms_block, si.symptom.name)
+            slider = slider_pool.acquire(si.intensity)
             self.sliders.append((slider, si))
             self.symptoms_block.add_widget(slider)
 
+    def release_panels(self):
+        for (slider, si) in self.sliders:
+            slider_pool.release(slider)
+        self.sliders = []
+        super(SymptomDetailEditBlock, self).release_panels()
+
     def update_record(self):
-        '''Update the record with fields from the block'''
+        '''Save the fields of the block to the record'''
         for (slider,si) in self.sliders:
             si.intensity = slider.value
+        self._save_edited_details([si for (slider, si) in self.sliders])
         
-    def _create_symptom_info(self):
-        if self.record.symptom_info is not None:
-            known_symptoms = set(map(operator.attrgetter('symptom_id'), self.record.symptom_info))
-        else:
-            known_symptoms = set()
-        app = SymptomDiaryApp.get_running_app()  
-        session = app.getDBSession()
-        all_symptoms_found = session.query(Symptom).filter(Symptom.active == True).all()
-        found_ids = set(map(operator.attrgetter('symptom_id'), all_symptoms_found))
-        for symptom_id in (found_ids - known_symptoms):
-            si = SymptomInfo(record_id=self.record.record_id, symptom_id=symptom_id, intensity=None)
-            session.add(si)
-        session.flush()
-        session.refresh(self.record)